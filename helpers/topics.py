@@ -15,6 +15,33 @@ class Topic:
         return False
 
 
+class TopicMatcher:
+    """
+    Matches a text against all topics at once. The text is lowercased and split once, and every token is looked
+    up in a tag -> topics map, which gives the same topics as calling tweet_is_about_topic on each topic.
+    A matcher is never modified, so it can be replaced atomically when the topics change.
+    """
+
+    def __init__(self, topics):
+        self.topics = list(topics)
+        self.tag_topics = dict()
+        for position, topic in enumerate(self.topics):
+            for tag in topic.tags:
+                positions = self.tag_topics.setdefault(tag, [])
+                if len(positions) == 0 or positions[-1] != position:
+                    positions.append(position)
+
+    def match(self, text):
+        """
+        :return: List of the topics the text is about, in the order the topics were given.
+        """
+        positions = set()
+        for token in set(text.lower().split()):
+            if token in self.tag_topics:
+                positions.update(self.tag_topics[token])
+        return [self.topics[position] for position in sorted(positions)]
+
+
 def get_static_topics():
     with open('data/ads_topics.json', 'r') as staticTopicData:
         d = json.load(staticTopicData)
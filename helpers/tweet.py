@@ -1,9 +1,11 @@
 import datetime
+import threading
 
 from helpers.topics import transform_topic_name
 from processing import regions, sentiment
 
 MINING_TOPIC_KEY = "TrendingTopic"
+MINING_TOPICS_KEY = "TrendingTopics"
 MINING_TEXT_KEY = "text"
 MINING_ID_KEY = "id"
 MINING_TIMESTAMP_KEY = "timestamp_ms"
@@ -12,6 +14,9 @@ MINING_PLACE_KEY = "place"
 MINING_USER_KEY = "user"
 MINING_USER_LOCATION_KEY = "location"
 
+# Bump when the sentiment or region classification changes, stored tweets with an older version get reclassified.
+CLASSIFIER_VERSION = 1
+
 
 def get_attribute_if_exists(d, key, default=None):
     return d[key] if key in d else default
@@ -29,25 +34,87 @@ def get_tweet_region_id(tweet_obj):
         return region.region_id
 
 
+# Sentinel for sentiment and region fields that were not loaded from the stored document.
+NOT_LOADED = object()
+
+classification_counts = {"sentiment": 0, "region": 0, "skipped": 0}
+classification_counts_lock = threading.Lock()
+
+
+def count_classification(kind):
+    with classification_counts_lock:
+        classification_counts[kind] += 1
+
+
+def get_classification_counts():
+    with classification_counts_lock:
+        return dict(classification_counts)
+
+
 class Tweet:
+    """
+    Fields missing from the (possibly projected) tweet document are None.
+    Sentiment and region are only classified when they are accessed and missing from the document.
+    """
+    __slots__ = ("id", "text", "tweet_id", "timestamp", "topic", "coordinates", "place", "user_location",
+                 "classifier_version", "_sentiment", "_region_id")
+
     def __init__(self, tweet_obj, use_parsed=False):
         self.id = get_attribute_if_exists(tweet_obj, "_id")
-        self.text = tweet_obj["text"]
-        self.tweet_id = tweet_obj["tweet_id"]
-        self.timestamp = tweet_obj["timestamp"]
-        self.topic = tweet_obj["topic"]
-        self.coordinates = tweet_obj["coordinates"]
-        self.place = tweet_obj["place"]
-        self.user_location = tweet_obj["user_location"]
-
-        self.sentiment = tweet_obj["sentiment"] if use_parsed and "sentiment" in tweet_obj \
-            else sentiment.get_tweet_sentiment(tweet_obj)
-        self.region_id = tweet_obj["region_id"] if use_parsed and "region_id" in tweet_obj \
-            else get_tweet_region_id(tweet_obj)
-
-    def process(self):
-        self.sentiment = sentiment.get_tweet_sentiment(self.get_original_dict())
-        self.region_id = get_tweet_region_id(self.get_original_dict())
+        self.text = get_attribute_if_exists(tweet_obj, "text")
+        self.tweet_id = get_attribute_if_exists(tweet_obj, "tweet_id")
+        self.timestamp = get_attribute_if_exists(tweet_obj, "timestamp")
+        self.topic = get_attribute_if_exists(tweet_obj, "topic")
+        self.coordinates = get_attribute_if_exists(tweet_obj, "coordinates")
+        self.place = get_attribute_if_exists(tweet_obj, "place")
+        self.user_location = get_attribute_if_exists(tweet_obj, "user_location")
+        self.classifier_version = get_attribute_if_exists(tweet_obj, "classifier_version") if use_parsed else None
+
+        self._sentiment = tweet_obj["sentiment"] if use_parsed and "sentiment" in tweet_obj else NOT_LOADED
+        self._region_id = tweet_obj["region_id"] if use_parsed and "region_id" in tweet_obj else NOT_LOADED
+
+    @property
+    def sentiment(self):
+        if self._sentiment is NOT_LOADED:
+            count_classification("sentiment")
+            self._sentiment = sentiment.get_tweet_sentiment(self.get_original_dict())
+        return self._sentiment
+
+    @sentiment.setter
+    def sentiment(self, value):
+        self._sentiment = value
+
+    @property
+    def region_id(self):
+        if self._region_id is NOT_LOADED:
+            count_classification("region")
+            self._region_id = get_tweet_region_id(self.get_original_dict())
+        return self._region_id
+
+    @region_id.setter
+    def region_id(self, value):
+        self._region_id = value
+
+    def classify(self):
+        """
+        Run any classification that is still missing.
+        """
+        return self.sentiment, self.region_id
+
+    def set_sentiment_scores(self, scores):
+        """
+        Use scores computed for a whole batch by sentiment.get_tweets_sentiment, instead of looking the text up again.
+        """
+        count_classification("sentiment")
+        self._sentiment = scores
+
+    def process(self, sentiment_scores=None):
+        self._sentiment = NOT_LOADED
+        self._region_id = NOT_LOADED
+        if sentiment_scores is not None:
+            self.set_sentiment_scores(sentiment_scores)
+        self.classify()
+        self.classifier_version = CLASSIFIER_VERSION
 
     def get_datetime(self):
         return datetime.datetime.fromtimestamp(self.timestamp)
@@ -75,7 +142,30 @@ class Tweet:
         arr["tweet_id"] = tweet_obj[MINING_ID_KEY]
         arr["timestamp"] = int(tweet_obj[MINING_TIMESTAMP_KEY]) // 1000
         arr["topic"] = transform_topic_name(get_attribute_if_exists(tweet_obj, MINING_TOPIC_KEY, ""))
-        return Tweet(arr, use_parsed=False)
+        tweet = Tweet(arr, use_parsed=False)
+        tweet.classifier_version = CLASSIFIER_VERSION
+        return tweet
+
+    @classmethod
+    def load_raw_tweets(cls, tweet_obj, sentiment_scores=None):
+        """
+        Load a mined tweet once per topic it matched, spool records list all of them in MINING_TOPICS_KEY.
+        Sentiment and region are classified once and shared by the copies.
+        :param sentiment_scores: Scores of the tweet text if they were already computed.
+        """
+        tweet = Tweet.load_raw_tweet(tweet_obj)
+        if sentiment_scores is not None:
+            tweet.set_sentiment_scores(sentiment_scores)
+        topics = get_attribute_if_exists(tweet_obj, MINING_TOPICS_KEY)
+        if topics is None:
+            return [tweet]
+        tweet.classify()
+        tweets = []
+        for topic in topics:
+            data = tweet.get_full_dict()
+            data["topic"] = transform_topic_name(topic)
+            tweets.append(Tweet(data, use_parsed=True))
+        return tweets
 
     @classmethod
     def load_stripped_tweet(cls, tweet_obj):
@@ -89,6 +179,7 @@ class Tweet:
             "region_id": self.region_id,
             "timestamp": self.timestamp,
             "topic": self.topic,
+            "classifier_version": self.classifier_version,
         }
 
     def get_original_dict(self):
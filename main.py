@@ -1,5 +1,4 @@
 import logging
-import os
 
 from flask import Flask
 
@@ -28,15 +27,41 @@ def get_twitter_token():
 
 from views import *
 from processing.scripts import *
-import mining
+from processing import indexes, regions, sentiment, close_mongo_clients
+from mining import ingestion
+from views import warmup
+
+EMBEDDED_INGESTION = app.config['EMBEDDED_INGESTION'] if 'EMBEDDED_INGESTION' in app.config else False
+
+
+def create_app(warm_up=True):
+    """
+    Application factory for WSGI servers, see wsgi.py. The regions, their spatial index and the sentiment analyzer,
+    which are otherwise loaded on first use, are loaded and the response cache is warmed up here, so a server that
+    preloads the application (gunicorn --preload) builds them once in the master and the forked workers share them
+    copy-on-write.
+    """
+    logging.info("Loading regions and sentiment analyzer")
+    regions.ensure_regions_loaded()
+    sentiment.get_analyzer()
+    logging.info("Creating indexes")
+    indexes.create_indexes()
+    if warm_up:
+        logging.info("Warming up caches")
+        warmup.warm_up()
+    else:
+        warmup.skip_warm_up()
+    # MongoClient is not fork-safe, disconnect so that forked workers reconnect on their first query.
+    close_mongo_clients()
+    return app
 
 
 def main():
-    logging.info("Populate MongoDB")
-    if 'SEND_OLD_TWEETS' not in os.environ or os.environ['SEND_OLD_TWEETS'] != "0":
-        mining.send_all_old_tweets()
-    logging.info("Starting mining")
-    mining.start_mining()
+    create_app()
+    # By default the ingestion service runs in its own process (flask ingest) and this process only reads.
+    if EMBEDDED_INGESTION:
+        logging.info("Starting ingestion")
+        ingestion.start_ingestion(cleanup=ingestion.is_cleanup_enabled())
     logging.info("Starting Flask Application.")
     app.run(host=app.config['HOSTNAME'], port=int(app.config['PORT']), threaded=True)
     logging.info("Flask application stopped running.")
@@ -1,10 +1,8 @@
 # Import the necessary methods from tweepy library
-import _thread
-import glob
 import html
 import json
 import logging
-import os
+import threading
 import time
 
 from tweepy import API
@@ -13,9 +11,10 @@ from tweepy import Stream
 from tweepy.streaming import StreamListener
 
 import mining.authentication
-from helpers.topics import Topic, get_static_topics
+from helpers.topics import Topic, TopicMatcher, get_static_topics
 from main import app
-from processing import scripts
+from mining.spool import SpoolWriter
+from mining.supervisor import MiningSupervisor
 
 MINING_TWEET_JSON_FILE = 'output/tweetlocation.json'
 STORING_INTERVAL = app.config['STORING_INTERVAL'] if 'STORING_INTERVAL' in app.config else 60 * 10  # 10 minutes
@@ -51,104 +50,74 @@ MINUTES_PER_QUERY = 1
 QUERIES_PER_BATCH = 2
 
 
+def process_raw_tweet(raw_data):
+    """
+    Parse a raw streamed tweet and match it against the current topics.
+    :return: List with the JSON line to store, which lists all matching topics, or an empty list.
+    """
+    data = json.loads(html.unescape(raw_data))
+    # Gives the content of the tweet.
+    tweet = str(data['text']) if 'text' in data else None
+    if tweet is None:
+        logging.error("Found empty tweet: {}".format(json.dumps(data)))
+        return []
+
+    # If tweet content contains any of the trending topic.
+    topic_names = [topic.topic_name for topic in StdOutListener.matcher.match(tweet)]
+    if len(topic_names) == 0:
+        return []
+    logging.info("Received relevant tweet ({}): {}".format(", ".join(topic_names), tweet))
+    # The tweet is stored once, the ingester inserts one copy per topic.
+    data['TrendingTopic'] = topic_names[0]
+    data['TrendingTopics'] = topic_names
+    return [json.dumps(data) + '\n']
+
+
+spool_writer = SpoolWriter(MINING_TWEET_JSON_FILE)
+mining_supervisor = MiningSupervisor(process_raw_tweet, spool_writer.write)
+
+
 class StdOutListener(StreamListener):
-    topics = []
+    matcher = TopicMatcher([])
 
-    # On every tweet arrival
+    # On every tweet arrival, hand it to the supervisor's processing workers.
     def on_data(self, data):
-        data = json.loads(html.unescape(data))
-        # Gives the content of the tweet.
-        tweet = str(data['text']) if 'text' in data else None
-        if tweet is None:
-            logging.error("Found empty tweet: {}".format(json.dumps(data)))
-            return True
-
-        # If tweet content contains any of the trending topic.
-        for topic in StdOutListener.topics:
-            if topic.tweet_is_about_topic(tweet):
-                logging.info("Received relevant tweet ({}): {}".format(topic.topic_name, tweet))
-                data['TrendingTopic'] = topic.topic_name
-                with open(MINING_TWEET_JSON_FILE, 'a') as tf:
-                    tf.write(json.dumps(data) + '\n')
+        mining_supervisor.submit(data)
         return True
 
     def on_error(self, status):
         logging.error("Received streaming error: {}".format(status))
 
 
-import processing.update
-
-
-def send_tweets(tweets_file=MINING_TWEET_JSON_FILE, move_old=False):
-    logging.info("SENDING TWEETS!")
-    try:
-        with open(tweets_file, 'r') as f:
-            for line in f.readlines():
-                if len(line.strip()) == 0:
-                    continue
-                try:
-                    tweet = json.loads(line.strip())
-                    processing.update.process_new_tweets([tweet])
-                except Exception as ex:
-                    logging.error(ex)
-                    logging.error("error for tweet: {}".format(line))
-        if move_old:
-            os.rename(tweets_file, "{}_{}".format(tweets_file, time.time()))
-    except Exception as ex:
-        logging.warning("Processing tweets failed, continuing!")
-        logging.warning(ex)
-
-
 def stream_tweets_for_region(name, bounding_box, consumer_keys, user_keys):
     logging.info("Streaming tweets for {}".format(name))
     consumer_key = consumer_keys['CONSUMER_KEY']
     consumer_secret = consumer_keys['CONSUMER_SECRET']
     access_token = user_keys['ACCESS_TOKEN']
     access_secret = user_keys['ACCESS_SECRET']
-    # This handles Twitter authentication and the connection to Twitter Streaming API
-    while True:
-        try:
-            l = StdOutListener()
-            auth = OAuthHandler(consumer_key, consumer_secret)
-            auth.set_access_token(access_token, access_secret)
-            stream = Stream(auth, l)
-            stream.filter(locations=bounding_box)
-        except:
-            logging.error("Need to restart for {}".format(name))
-
-
-def send_all_old_tweets_thread():
-    logging.info("Start storing old tweets")
-    tweet_files = glob.glob(MINING_TWEET_JSON_FILE + "_*")
-    for tweet_filename in tweet_files:
-        send_tweets(tweet_filename, move_old=False)
-    logging.info("Done storing old tweets")
-    logging.info("MongoDB population DONE")
-    logging.info("Starting to run cleanup functions")
-    logging.info("Remove irrelevant tweets:")
-    scripts.remove_irrelevant_tweets()
-    logging.info("Done")
-    logging.info("Update sentiment and region classification")
-    scripts.update_sentiment_and_region_classification()
-    logging.info("Done")
-
-
-def send_all_old_tweets():
-    _thread.start_new_thread(send_all_old_tweets_thread, ())
+    # This handles Twitter authentication and the connection to Twitter Streaming API.
+    # The supervisor restarts it with exponential backoff when the stream stops.
+    l = StdOutListener()
+    auth = OAuthHandler(consumer_key, consumer_secret)
+    auth.set_access_token(access_token, access_secret)
+    stream = Stream(auth, l)
+    stream.filter(locations=bounding_box)
 
 
 def start_mining():
-    _thread.start_new_thread(master_mining_thread, ())
+    threading.Thread(target=master_mining_thread, name="mining", daemon=True).start()
 
 
 def start_region_threads(consumer_keys, mining_keys):
     min_length = min(len(streaming_regions), len(mining_keys))
     logging.debug("Found {} regions and key tuples".format(min_length))
+    mining_supervisor.start()
     for region, user_keys in zip(streaming_regions[:min_length], mining_keys[:min_length]):
-        _thread.start_new_thread(stream_tweets_for_region, (region['name'], region['bounding_box'], consumer_keys, {
-            "ACCESS_TOKEN": user_keys[0],
-            "ACCESS_SECRET": user_keys[1]
-        }))
+        mining_supervisor.start_worker("stream-{}".format(region['name']), stream_tweets_for_region,
+                                       region['name'], region['bounding_box'], consumer_keys, {
+                                           "ACCESS_TOKEN": user_keys[0],
+                                           "ACCESS_SECRET": user_keys[1]
+                                       })
         time.sleep(10)
 
 
@@ -165,8 +134,9 @@ def get_trending_topics(consumer_key, consumer_secret, access_token, access_secr
 def update_all_topics(static_topics, consumer_keys, mining_keys):
     trending_topics = get_trending_topics(consumer_keys['CONSUMER_KEY'], consumer_keys['CONSUMER_SECRET'],
                                           mining_keys[0][0], mining_keys[0][1])
-    StdOutListener.topics = trending_topics + static_topics
-    logging.info("All topics are now: {}".format([x.topic_name for x in StdOutListener.topics]))
+    # Swap in a new matcher in a single assignment, processing workers keep using the old one until then.
+    StdOutListener.matcher = TopicMatcher(trending_topics + static_topics)
+    logging.info("All topics are now: {}".format([x.topic_name for x in StdOutListener.matcher.topics]))
 
 
 def master_mining_thread():
@@ -178,9 +148,13 @@ def master_mining_thread():
     mining_keys = mining.authentication.get_authentication_keys()
     logging.debug("Mining keys: {}".format(mining_keys))
     update_all_topics(static_topics, consumer_keys, mining_keys)
+    spool_writer.recover()
     start_region_threads(consumer_keys, mining_keys)
     while True:
-        send_tweets(move_old=True)
+        logging.info("Mining metrics: {}, spool: {}".format(mining_supervisor.get_metrics(),
+                                                            spool_writer.get_metrics()))
+        # Hand the tweets of the last period to the ingester.
+        spool_writer.seal()
         update_all_topics(static_topics, consumer_keys, mining_keys)
         time.sleep(STORING_INTERVAL)
 
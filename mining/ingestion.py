@@ -0,0 +1,84 @@
+"""
+Ingestion service, run with `flask ingest` in its own process next to the web server.
+It mines tweets into the spool, stores the sealed spool segments with a pipeline of processes that parse and classify
+the tweets while this process bulk writes them, and publishes the ingestion state in the metadata collection.
+The web process only reads, get_ingestion_state tells it how fresh the data is.
+"""
+
+import glob
+import logging
+import os
+import threading
+import time
+
+import mining
+from main import app
+from mining import replay
+from processing import indexes, scripts, sentiment, summaries, set_metadata, INGESTION_METADATA_KEY
+
+INGESTION_POLL_INTERVAL = app.config['INGESTION_POLL_INTERVAL'] if 'INGESTION_POLL_INTERVAL' in app.config \
+    else 10  # seconds
+INGESTION_PROCESSES = app.config['INGESTION_PROCESSES'] if 'INGESTION_PROCESSES' in app.config else 2
+
+
+def get_sealed_segments():
+    return sorted(glob.glob(mining.MINING_TWEET_JSON_FILE + "_*"), key=os.path.getmtime)
+
+
+def ingest_sealed_segments(processes=0, pool=None):
+    """
+    Store the sealed spool segments that are not stored yet and publish the time of the pass.
+    """
+    progress = replay.replay_segments(get_sealed_segments(), processes=processes, pool=pool)
+    set_metadata(INGESTION_METADATA_KEY, ingested_at=time.time())
+    return progress
+
+
+def is_cleanup_enabled():
+    """
+    SEND_OLD_TWEETS=0 used to skip both storing the old tweet files and the cleanup that followed. The sealed spool
+    segments are always stored now, the replay manifest skips what is already stored, so it only skips the cleanup.
+    """
+    return os.environ.get('SEND_OLD_TWEETS') != "0"
+
+
+def run_cleanup():
+    logging.info("Starting to run cleanup functions")
+    logging.info("Remove irrelevant tweets:")
+    scripts.remove_irrelevant_tweets()
+    logging.info("Done")
+    logging.info("Update sentiment and region classification")
+    scripts.update_sentiment_and_region_classification()
+    logging.info("Done")
+    logging.info("Rebuild tweet summaries")
+    summaries.rebuild_summaries()
+    logging.info("Done")
+
+
+def run_ingestion(processes=INGESTION_PROCESSES, mine=True, cleanup=True):
+    """
+    Run the ingestion service forever.
+    :param mine: Whether to stream tweets into the spool, the segments may also come from another miner.
+    :param cleanup: Whether to run the cleanup scripts once the existing segments are stored.
+    """
+    indexes.create_indexes()
+    # Fork the classification processes before any other thread is started.
+    pool = sentiment.create_pool(processes) if processes > 0 else None
+    if mine:
+        logging.info("Starting mining")
+        mining.start_mining()
+    logging.info("Start storing old tweets")
+    ingest_sealed_segments(processes, pool)
+    logging.info("Done storing old tweets")
+    if cleanup:
+        run_cleanup()
+    while True:
+        time.sleep(INGESTION_POLL_INTERVAL)
+        ingest_sealed_segments(processes, pool)
+
+
+def start_ingestion(cleanup=True):
+    """
+    Run the ingestion service in a thread of the current process, without classification processes.
+    """
+    threading.Thread(target=run_ingestion, args=(0, True, cleanup), name="ingestion", daemon=True).start()
@@ -0,0 +1,231 @@
+"""
+Replay of spool segments into MongoDB.
+The replay manifest (db.replay_manifest) stores, for every segment, the byte offset up to which its lines are stored,
+so restarts resume where the previous run stopped and never re-read ingested data.
+Parsing and classification can run in a process pool, the calling process does all the writes.
+"""
+
+import collections
+import gzip
+import json
+import logging
+import os
+import threading
+import time
+
+from helpers.tweet import Tweet
+from main import app
+from processing import db, ingestion_db, sentiment, update
+
+REPLAY_PROCESSES = app.config['REPLAY_PROCESSES'] if 'REPLAY_PROCESSES' in app.config else 0
+REPLAY_BATCH_SIZE = app.config['REPLAY_BATCH_SIZE'] if 'REPLAY_BATCH_SIZE' in app.config else 2000
+REPLAY_PROGRESS_INTERVAL = 10  # seconds between progress reports
+BATCHES_IN_FLIGHT_PER_PROCESS = 2
+
+# Segments currently replayed by a thread of this process, other threads skip them.
+replaying_segments = set()
+replaying_segments_lock = threading.Lock()
+
+
+def get_segment_key(path):
+    return os.path.basename(path)
+
+
+def get_manifest_entries(paths):
+    """
+    Read the manifest entries of all the segments with a single query.
+    :return: Dictionary from path to manifest entry, segments without an entry start at offset 0.
+    """
+    keys = [get_segment_key(path) for path in paths]
+    entries = {entry["_id"]: entry for entry in db.replay_manifest.find({"_id": {"$in": keys}},
+                                                                         {"offset": 1, "complete": 1})}
+    return {path: entries.get(key, {"offset": 0, "complete": False}) for path, key in zip(paths, keys)}
+
+
+def record_progress(path, offset, complete, nb_lines, nb_inserted, nb_duplicates, nb_errors):
+    ingestion_db.replay_manifest.update_one({"_id": get_segment_key(path)}, {
+        "$set": {"offset": offset, "complete": complete, "updated": time.time()},
+        "$inc": {"lines": nb_lines, "inserted": nb_inserted, "duplicates": nb_duplicates, "errors": nb_errors}
+    }, upsert=True)
+
+
+def open_segment_bytes(path):
+    if path.endswith(".gz"):
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+
+def get_raw_position(f):
+    """
+    :return: Position in the file on disk, which differs from the line offsets for compressed segments.
+    """
+    if isinstance(f, gzip.GzipFile):
+        return f.fileobj.tell()
+    return f.tell()
+
+
+def read_segment_batches(path, offset, batch_size):
+    """
+    Read the lines of a segment from a byte offset.
+    :return: Generator of (lines, offset after the last line, position in the file on disk, end of segment).
+    """
+    with open_segment_bytes(path) as f:
+        f.seek(offset)
+        lines = []
+        for line in f:
+            offset += len(line)
+            lines.append(line)
+            if len(lines) >= batch_size:
+                yield lines, offset, get_raw_position(f), False
+                lines = []
+        yield lines, offset, get_raw_position(f), True
+
+
+def classify_lines(lines):
+    """
+    Parse and classify a batch of spooled lines, runs in the replay processes.
+    :return: Tuple (classified tweet documents, number of lines that failed to parse).
+    """
+    tweet_objs = []
+    nb_errors = 0
+    for line in lines:
+        line = line.decode('utf-8').strip()
+        if len(line) == 0:
+            continue
+        try:
+            tweet_objs.append(json.loads(line))
+        except Exception as ex:
+            nb_errors += 1
+            logging.error(ex)
+            logging.error("error for tweet: {}".format(line))
+    return [tweet.get_full_dict() for tweet in update.classify_tweets(tweet_objs)], nb_errors
+
+
+class ReplayProgress:
+    def __init__(self, total_size):
+        self.total_size = total_size
+        self.done_size = 0
+        self.nb_lines = 0
+        self.nb_inserted = 0
+        self.nb_duplicates = 0
+        self.nb_errors = 0
+        self.start_time = time.time()
+        self.last_report = self.start_time
+
+    def add(self, size, nb_lines, nb_inserted, nb_duplicates, nb_errors):
+        self.done_size += size
+        self.nb_lines += nb_lines
+        self.nb_inserted += nb_inserted
+        self.nb_duplicates += nb_duplicates
+        self.nb_errors += nb_errors
+        if time.time() - self.last_report >= REPLAY_PROGRESS_INTERVAL:
+            self.report()
+
+    def get_eta(self):
+        elapsed = time.time() - self.start_time
+        if self.done_size == 0:
+            return None
+        return elapsed * (self.total_size - self.done_size) / self.done_size
+
+    def report(self, done=False):
+        self.last_report = time.time()
+        elapsed = self.last_report - self.start_time
+        eta = self.get_eta()
+        logging.info("{} {:.1f}/{:.1f} MB ({:.0f}%) in {:.0f} seconds ({:.0f} tweets/s{}): "
+                     "{} inserted, {} already stored, {} errors"
+                     .format("Replayed" if done else "Replaying", self.done_size / 1e6, self.total_size / 1e6,
+                             100.0 * self.done_size / self.total_size if self.total_size > 0 else 100, elapsed,
+                             self.nb_lines / elapsed if elapsed > 0 else 0,
+                             ", ETA {:.0f} seconds".format(eta) if eta is not None and not done else "",
+                             self.nb_inserted, self.nb_duplicates, self.nb_errors))
+
+
+def claim_pending_segments(paths):
+    """
+    :return: List of (path, offset) for segments that are not fully stored and not replayed by another thread.
+    """
+    pending = []
+    entries = get_manifest_entries(paths)
+    with replaying_segments_lock:
+        for path in paths:
+            entry = entries[path]
+            if entry["complete"] or path in replaying_segments:
+                continue
+            replaying_segments.add(path)
+            pending.append((path, entry["offset"]))
+    return pending
+
+
+def release_segments(segments):
+    with replaying_segments_lock:
+        for path, offset in segments:
+            replaying_segments.discard(path)
+
+
+def replay_segments(paths, processes=REPLAY_PROCESSES, batch_size=REPLAY_BATCH_SIZE, pool=None):
+    """
+    Store the lines of the given segments that are not stored yet. The manifest is updated after every batch.
+    :param processes: Number of processes used to parse and classify tweets, 0 to do it in-process.
+    :param pool: Long-lived pool of that many processes to use instead of creating one.
+    :return: ReplayProgress with the totals.
+    """
+    segments = claim_pending_segments(paths)
+    progress = ReplayProgress(sum(os.path.getsize(path) - (offset if not path.endswith(".gz") else 0)
+                                  for path, offset in segments))
+    if len(segments) == 0:
+        return progress
+    logging.info("Replaying {} segments".format(len(segments)))
+    owns_pool = pool is None and processes > 0
+    if owns_pool:
+        pool = sentiment.create_pool(processes)
+    max_in_flight = max(1, processes * BATCHES_IN_FLIGHT_PER_PROCESS)
+    in_flight = collections.deque()
+    positions = {path: offset if not path.endswith(".gz") else 0 for path, offset in segments}
+    failed_paths = set()
+
+    def store_batch(path, nb_lines, end_offset, raw_position, complete, result):
+        if path in failed_paths:
+            # Keep the manifest at the failed batch, the segment is resumed from there on the next replay.
+            return
+        try:
+            tweet_dicts, nb_errors = result.get() if pool is not None else result
+            nb_inserted, nb_duplicates = update.store_tweets([Tweet(tweet_dict, use_parsed=True)
+                                                              for tweet_dict in tweet_dicts])
+        except Exception as ex:
+            failed_paths.add(path)
+            logging.error(ex)
+            logging.error("error for batch of {} tweets from {}".format(nb_lines, path))
+            return
+        record_progress(path, end_offset, complete, nb_lines, nb_inserted, nb_duplicates, nb_errors)
+        progress.add(raw_position - positions[path], nb_lines, nb_inserted, nb_duplicates, nb_errors)
+        positions[path] = raw_position
+
+    def read_batches():
+        for path, offset in segments:
+            try:
+                for batch in read_segment_batches(path, offset, batch_size):
+                    yield (path,) + batch
+            except Exception as ex:
+                logging.warning("Reading {} failed, continuing!".format(path))
+                logging.warning(ex)
+
+    try:
+        # Batches of the next segments are classified while the previous ones are stored.
+        for path, lines, end_offset, raw_position, complete in read_batches():
+            if pool is not None:
+                result = pool.apply_async(classify_lines, (lines,))
+            else:
+                result = classify_lines(lines)
+            in_flight.append((path, len(lines), end_offset, raw_position, complete, result))
+            while len(in_flight) >= max_in_flight:
+                store_batch(*in_flight.popleft())
+        while len(in_flight) > 0:
+            store_batch(*in_flight.popleft())
+    finally:
+        if owns_pool:
+            pool.close()
+            pool.join()
+        release_segments(segments)
+    progress.report(done=True)
+    logging.info("Sentiment cache: {}".format(sentiment.get_cache_stats()))
+    return progress
@@ -0,0 +1,110 @@
+import glob
+import gzip
+import logging
+import os
+import threading
+import time
+
+from main import app
+
+SPOOL_SEGMENT_MAX_SIZE = app.config['SPOOL_SEGMENT_MAX_SIZE'] if 'SPOOL_SEGMENT_MAX_SIZE' in app.config \
+    else 64 * 1024 * 1024  # bytes
+SPOOL_SEGMENT_MAX_AGE = app.config['SPOOL_SEGMENT_MAX_AGE'] if 'SPOOL_SEGMENT_MAX_AGE' in app.config \
+    else 60 * 10  # seconds
+SPOOL_COMPRESSION = app.config['SPOOL_COMPRESSION'] if 'SPOOL_COMPRESSION' in app.config else False
+PART_SUFFIX = ".part"
+COMPRESSED_SUFFIX = ".gz"
+
+
+def open_segment(path, mode='r'):
+    """
+    Open a spool segment as text, decompressing it if needed.
+    """
+    if path.endswith(COMPRESSED_SUFFIX):
+        return gzip.open(path, mode + 't', encoding='utf-8')
+    return open(path, mode, encoding='utf-8')
+
+
+class SpoolWriter:
+    """
+    Appends mined tweets to a single open segment file and seals it when its size on disk grows too large or when it
+    grows too old.
+    The open segment is {prefix}.part; sealing renames it to {prefix}_{timestamp}, so the ingester, which picks up
+    every {prefix}_* file, only ever sees complete segments.
+    """
+
+    def __init__(self, prefix, max_size=SPOOL_SEGMENT_MAX_SIZE, max_age=SPOOL_SEGMENT_MAX_AGE,
+                 compress=SPOOL_COMPRESSION):
+        self.prefix = prefix
+        self.max_size = max_size
+        self.max_age = max_age
+        self.compress = compress
+        self.lock = threading.Lock()
+        self.segment = None
+        self.segment_size = 0
+        self.segment_opened_at = None
+        self.nb_written = 0
+        self.nb_segments = 0
+
+    def get_part_path(self):
+        return self.prefix + PART_SUFFIX + (COMPRESSED_SUFFIX if self.compress else "")
+
+    def get_sealed_path(self):
+        return "{}_{}".format(self.prefix, time.time()) + (COMPRESSED_SUFFIX if self.compress else "")
+
+    def recover(self):
+        """
+        Seal segments left open by a previous run, including the legacy unsealed tweets file.
+        """
+        with self.lock:
+            leftovers = glob.glob(self.prefix + PART_SUFFIX + "*")
+            if os.path.exists(self.prefix):
+                leftovers.append(self.prefix)
+            for path in leftovers:
+                sealed_path = "{}_{}".format(self.prefix, time.time())
+                if path.endswith(COMPRESSED_SUFFIX):
+                    sealed_path += COMPRESSED_SUFFIX
+                os.rename(path, sealed_path)
+                logging.info("Recovered spool segment {}".format(sealed_path))
+
+    def write(self, records):
+        """
+        Write a batch of JSON lines with a single write call.
+        """
+        data = "".join(records)
+        with self.lock:
+            if self.segment is None:
+                self.segment = open_segment(self.get_part_path(), 'a')
+                self.segment_size = 0
+                self.segment_opened_at = time.time()
+            self.segment.write(data)
+            self.segment.flush()
+            # Size on disk, which is smaller than the written text for compressed segments.
+            self.segment_size = os.fstat(self.segment.fileno()).st_size
+            self.nb_written += len(records)
+            if self.segment_size >= self.max_size or time.time() - self.segment_opened_at >= self.max_age:
+                self.seal_segment()
+
+    def seal_segment(self):
+        if self.segment is None:
+            return
+        self.segment.close()
+        self.segment = None
+        sealed_path = self.get_sealed_path()
+        os.rename(self.get_part_path(), sealed_path)
+        self.nb_segments += 1
+
+    def seal(self):
+        """
+        Seal the open segment, if any, so that it can be ingested.
+        """
+        with self.lock:
+            self.seal_segment()
+
+    def get_metrics(self):
+        with self.lock:
+            return {
+                "written": self.nb_written,
+                "sealed_segments": self.nb_segments,
+                "open_segment_size": self.segment_size if self.segment is not None else 0
+            }
@@ -0,0 +1,141 @@
+import logging
+import queue
+import threading
+import time
+
+from main import app
+
+MINING_QUEUE_SIZE = app.config['MINING_QUEUE_SIZE'] if 'MINING_QUEUE_SIZE' in app.config else 10000
+MINING_PROCESSING_WORKERS = app.config['MINING_PROCESSING_WORKERS'] \
+    if 'MINING_PROCESSING_WORKERS' in app.config else 2
+ENQUEUE_TIMEOUT = 1  # seconds a stream worker blocks on a full queue before dropping the tweet
+RESTART_MIN_BACKOFF = 1
+RESTART_MAX_BACKOFF = 15 * 60
+HEALTHY_RUN_TIME = 5 * 60  # a worker that ran this long restarts with the minimal backoff
+WRITER_BATCH_SIZE = 500
+
+
+class MiningSupervisor:
+    """
+    Owns the mining threads:
+    - stream workers push raw tweets onto a bounded queue and are restarted with exponential backoff,
+    - processing workers parse and match the raw tweets and push the records to write on a second bounded queue,
+    - a single writer worker drains that queue and appends the records in batches.
+    When a queue is full, producers block for ENQUEUE_TIMEOUT and then drop the item.
+    """
+
+    def __init__(self, process, write, queue_size=MINING_QUEUE_SIZE, nb_processing_workers=MINING_PROCESSING_WORKERS):
+        """
+        :param process: Function from a raw tweet to the list of records to write.
+        :param write: Function writing a list of records.
+        """
+        self.process = process
+        self.write = write
+        self.nb_processing_workers = nb_processing_workers
+        self.raw_queue = queue.Queue(maxsize=queue_size)
+        self.write_queue = queue.Queue(maxsize=queue_size)
+        self.lock = threading.Lock()
+        self.metrics = {
+            "received": 0,
+            "dropped_raw": 0,
+            "processed": 0,
+            "processing_errors": 0,
+            "dropped_records": 0,
+            "written": 0,
+            "writing_errors": 0,
+            "max_raw_queue_depth": 0,
+            "max_write_queue_depth": 0,
+        }
+        self.restarts = dict()
+        self.started = False
+
+    def count(self, metric, value=1):
+        with self.lock:
+            self.metrics[metric] += value
+
+    def enqueue(self, target_queue, item, dropped_metric, depth_metric):
+        try:
+            target_queue.put(item, timeout=ENQUEUE_TIMEOUT)
+        except queue.Full:
+            self.count(dropped_metric)
+            return False
+        with self.lock:
+            self.metrics[depth_metric] = max(self.metrics[depth_metric], target_queue.qsize())
+        return True
+
+    def submit(self, raw_tweet):
+        """
+        Called from the stream threads for every received tweet.
+        """
+        self.count("received")
+        if not self.enqueue(self.raw_queue, raw_tweet, "dropped_raw", "max_raw_queue_depth"):
+            logging.warning("Mining queue is full, dropped a tweet")
+
+    def processing_worker(self):
+        while True:
+            raw_tweet = self.raw_queue.get()
+            try:
+                records = self.process(raw_tweet)
+                self.count("processed")
+            except Exception as ex:
+                self.count("processing_errors")
+                logging.error("Failed to process tweet: {}".format(ex))
+                continue
+            for record in records:
+                self.enqueue(self.write_queue, record, "dropped_records", "max_write_queue_depth")
+
+    def writer_worker(self):
+        while True:
+            records = [self.write_queue.get()]
+            while len(records) < WRITER_BATCH_SIZE:
+                try:
+                    records.append(self.write_queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self.write(records)
+                self.count("written", len(records))
+            except Exception as ex:
+                self.count("writing_errors", len(records))
+                logging.error("Failed to write {} tweets: {}".format(len(records), ex))
+
+    def supervise(self, name, target, *args):
+        """
+        Run target forever, restarting it with exponential backoff whenever it returns or raises.
+        """
+        backoff = RESTART_MIN_BACKOFF
+        while True:
+            start_time = time.time()
+            try:
+                target(*args)
+                logging.warning("Worker {} stopped".format(name))
+            except Exception as ex:
+                logging.error("Worker {} failed: {}".format(name, ex))
+            if time.time() - start_time >= HEALTHY_RUN_TIME:
+                backoff = RESTART_MIN_BACKOFF
+            with self.lock:
+                self.restarts[name] = self.restarts.get(name, 0) + 1
+            logging.error("Need to restart {} in {} seconds".format(name, backoff))
+            time.sleep(backoff)
+            backoff = min(backoff * 2, RESTART_MAX_BACKOFF)
+
+    def start_worker(self, name, target, *args):
+        thread = threading.Thread(target=self.supervise, args=(name, target) + args, name=name, daemon=True)
+        thread.start()
+        return thread
+
+    def start(self):
+        if self.started:
+            return
+        self.started = True
+        for i in range(self.nb_processing_workers):
+            self.start_worker("processing-{}".format(i), self.processing_worker)
+        self.start_worker("writer", self.writer_worker)
+
+    def get_metrics(self):
+        with self.lock:
+            metrics = dict(self.metrics)
+            metrics["restarts"] = dict(self.restarts)
+        metrics["raw_queue_depth"] = self.raw_queue.qsize()
+        metrics["write_queue_depth"] = self.write_queue.qsize()
+        return metrics
@@ -1,6 +1,6 @@
 import calendar
 import datetime
-import logging
+import threading
 
 from helpers.tweet import Tweet
 from processing import regions
@@ -10,18 +10,40 @@ SHORT_PERIOD = datetime.timedelta(days=-1)
 SHORT_INTERVAL_LENGTH = datetime.timedelta(hours=1)
 LONG_INTERVAL_LENGTH = datetime.timedelta(days=1)
 
-from pymongo import MongoClient, ASCENDING, errors
+from pymongo import ASCENDING
 
-from main import app
+from processing.database import create_mongo_client, close_mongo_clients, get_pool_stats
+from processing.database import mongo, db, ingestion_db, analytics_db, maintenance_db
 
-mongo = MongoClient(app.config['MONGO_HOST'], app.config['MONGO_PORT'])
-db = mongo.database
 
-db.tweets.create_index("tweet_id")
-try:
-    db.tweets.create_index([("tweet_id", ASCENDING), ("topic", ASCENDING)], unique=True)
-except errors.DuplicateKeyError as err:
-    logging.error("Failed to create a unique index: {}".format(err))
+def get_metadata(key):
+    return db.metadata.find_one({"_id": key})
+
+
+def set_metadata(key, **values):
+    db.metadata.update_one({"_id": key}, {"$set": values}, upsert=True)
+
+
+INGESTION_METADATA_KEY = "ingestion"
+
+
+def get_ingestion_state():
+    """
+    :return: Dictionary with the ingestion watermark (newest stored tweet timestamp), the earliest stored tweet
+    timestamp, the data generation, which is bumped whenever data before the watermark may have changed, and the time
+    the ingester last finished storing the spooled tweets.
+    """
+    state = get_metadata(INGESTION_METADATA_KEY)
+    return {
+        "watermark": state.get("watermark", 0) if state is not None else 0,
+        "earliest": state.get("earliest") if state is not None else None,
+        "generation": state.get("generation", 0) if state is not None else 0,
+        "ingested_at": state.get("ingested_at") if state is not None else None
+    }
+
+
+def bump_data_generation():
+    db.metadata.update_one({"_id": INGESTION_METADATA_KEY}, {"$inc": {"generation": 1}}, upsert=True)
 
 
 def get_short_term_start():
@@ -35,9 +57,12 @@ def get_short_term_start():
 def get_long_intervals_between(start, end):
     assert (datetime.timedelta(days=1).total_seconds() % LONG_INTERVAL_LENGTH.total_seconds() == 0), \
         "LONG_INTERVAL_LENGTH must fit an integer number of times into a day"
-    intervals = []
     start_day = start.date()
     current_start = datetime.datetime.combine(start_day, datetime.time())
+    return extend_long_intervals([], current_start, end)
+
+
+def extend_long_intervals(intervals, current_start, end):
     while current_start + LONG_INTERVAL_LENGTH <= end:
         intervals.append((current_start, current_start + LONG_INTERVAL_LENGTH))
         current_start += LONG_INTERVAL_LENGTH
@@ -54,17 +79,74 @@ def get_short_intervals():
     return intervals
 
 
+def seed_earliest_time():
+    """
+    Copy the earliest tweet timestamp of the collection into the ingestion metadata, for databases that were filled
+    before the metadata kept it. The lookup uses the timestamp index.
+    :return: The earliest tweet timestamp, None if there are no tweets.
+    """
+    tweet = db.tweets.find_one(sort=[("timestamp", ASCENDING)], projection={"timestamp": 1})
+    if tweet is None:
+        return None
+    db.metadata.update_one({"_id": INGESTION_METADATA_KEY}, {"$min": {"earliest": tweet["timestamp"]}}, upsert=True)
+    return tweet["timestamp"]
+
+
 def get_earliest_time():
-    tweet = Tweet.load_stripped_tweet(db.tweets.find_one(sort=[("timestamp", 1)]))
-    return tweet.get_datetime()
+    """
+    The earliest tweet timestamp is kept in the ingestion metadata, so this does not sort the tweets collection.
+    """
+    earliest = get_ingestion_state()["earliest"]
+    if earliest is None:
+        earliest = seed_earliest_time()
+        if earliest is None:
+            return None
+    return datetime.datetime.fromtimestamp(earliest)
+
+
+class IntervalCatalogue:
+    """
+    Keeps the long intervals in memory and only appends the intervals that were completed since the last call.
+    They are regenerated when the earliest tweet moves to another day.
+    """
+
+    def __init__(self):
+        self.start_day = None
+        self.long_intervals = []
+        self.lock = threading.Lock()
+
+    def get_long_intervals(self, start_date, end):
+        with self.lock:
+            if start_date is None:
+                self.start_day = None
+                self.long_intervals = []
+            elif self.start_day != start_date.date():
+                self.start_day = start_date.date()
+                self.long_intervals = get_long_intervals_between(start_date, end)
+            elif len(self.long_intervals) == 0:
+                self.long_intervals = get_long_intervals_between(start_date, end)
+            else:
+                extend_long_intervals(self.long_intervals, self.long_intervals[-1][1], end)
+            return list(self.long_intervals)
+
+
+interval_catalogue = IntervalCatalogue()
 
 
 def get_intervals():
-    start_date = get_earliest_time()
-    long_intervals = get_long_intervals_between(start_date, get_short_term_start())
+    long_intervals = interval_catalogue.get_long_intervals(get_earliest_time(), get_short_term_start())
     short_intervals = get_short_intervals()
     return long_intervals + short_intervals
 
 
 def get_last_interval():
-    return get_intervals()[-1]
+    """
+    :return: The most recent interval, None if there are no tweets yet.
+    """
+    short_intervals = get_short_intervals()
+    if len(short_intervals) > 0:
+        return short_intervals[-1]
+    long_intervals = interval_catalogue.get_long_intervals(get_earliest_time(), get_short_term_start())
+    if len(long_intervals) == 0:
+        return None
+    return long_intervals[-1]
@@ -3,16 +3,23 @@ Initial version loads data from files.
 Better version loads file content to memory and updates on changes.
 """
 
+import bisect
 import datetime
 import logging
 import time
 
-from processing import db, get_last_interval, Tweet, get_intervals
-from processing import regions
+import numpy as np
+
+from processing import analytics_db, get_last_interval, Tweet, get_intervals
+from processing import regions, summaries
 
 
 def get_interval_filter(interval):
-    return {"timestamp": {"$gt": interval[0].timestamp(), "$lt": interval[1].timestamp()}}
+    return {"timestamp": {"$gte": interval[0].timestamp(), "$lt": interval[1].timestamp()}}
+
+
+def get_summaries_interval_filter(interval):
+    return {"interval_start": {"$gte": interval[0].timestamp(), "$lt": interval[1].timestamp()}}
 
 
 def get_topic_filter(topic):
@@ -28,38 +35,160 @@ def get_tweets_in_interval(interval):
     return get_tweets(get_interval_filter(interval))
 
 
-def get_tweets_in_interval_region_topic(interval, location_id, topic):
+def get_interval_region_topic_query(interval, location_id, topic):
     query = dict()
     query.update(get_children_locations_filter(location_id))
     query.update(get_interval_filter(interval))
     query.update(get_topic_filter(topic))
-    return get_tweets(query)
+    return query
+
+
+def get_interval_topic_query(interval, topic):
+    query = dict()
+    query.update(get_interval_filter(interval))
+    query.update(get_topic_filter(topic))
+    return query
+
+
+def get_tweets_in_interval_region_topic(interval, location_id, topic):
+    return get_tweets(get_interval_region_topic_query(interval, location_id, topic))
 
 
 def get_tweets(query):
     logging.info("Getting tweets for query: {}".format(query))
     logging.info("Nb results: {}".format(count_tweets(query)))
     start_time = time.time()
-    tweets = db.tweets.find(query)
+    tweets = analytics_db.tweets.find(query)
     end_time = time.time()
     logging.info("Took {} seconds".format(end_time - start_time))
     return [Tweet.load_stripped_tweet(tweet) for tweet in tweets]
 
 
 def count_tweets(query):
-    return db.tweets.count(query)
+    return analytics_db.tweets.count(query)
 
 
 def get_tweets_in_interval_for_topic(interval, topic):
-    query = dict()
-    query.update(get_interval_filter(interval))
-    query.update(get_topic_filter(topic))
-    return get_tweets(query)
+    return get_tweets(get_interval_topic_query(interval, topic))
+
+
+# Stored tweet fields returned by the download streams.
+TWEET_DOCUMENT_FIELDS = ("tweet_id", "text", "timestamp", "topic", "coordinates", "place", "user_location",
+                         "sentiment", "region_id")
+
+
+def get_download_query(interval, topic=None, location_id=None):
+    query = get_interval_filter(interval)
+    if topic is not None:
+        query.update(get_topic_filter(topic))
+    if location_id is not None:
+        query.update(get_children_locations_filter(location_id))
+    return query
+
+
+def get_download_sort(topic=None):
+    """
+    Downloads are ordered by (timestamp, tweet_id, topic), which is unique. The topic is left out when it is
+    filtered on, so that the (topic, timestamp, tweet_id) index provides the order.
+    """
+    sort = [("timestamp", 1), ("tweet_id", 1)]
+    if topic is None:
+        sort.append(("topic", 1))
+    return sort
+
+
+def get_download_cursor(document):
+    """
+    :return: Cursor resuming a download after the given tweet document.
+    """
+    return "{}:{}:{}".format(document["timestamp"], document["tweet_id"], document["topic"])
+
+
+def parse_download_cursor(cursor):
+    timestamp, tweet_id, topic = cursor.split(":", 2)
+    return int(timestamp), int(tweet_id), topic
+
+
+def iter_tweet_documents(interval, topic=None, location_id=None, cursor=None, limit=None, batch_size=1000):
+    """
+    Stream the stored tweets of an interval in download order, without building Tweet objects.
+    :param cursor: Value of get_download_cursor for the last tweet already received.
+    :return: Generator of tweet documents with the TWEET_DOCUMENT_FIELDS, missing fields are None.
+    """
+    if limit == 0:
+        return
+    query = get_download_query(interval, topic, location_id)
+    after = None
+    if cursor is not None:
+        after = parse_download_cursor(cursor)
+        query["timestamp"]["$gte"] = max(query["timestamp"]["$gte"], after[0])
+    projection = dict({field: 1 for field in TWEET_DOCUMENT_FIELDS}, _id=0)
+    documents = analytics_db.tweets.find(query, projection, sort=get_download_sort(topic), batch_size=batch_size)
+    nb_documents = 0
+    for document in documents:
+        # The cursor query starts at the cursor timestamp, skip what was already sent at that timestamp.
+        if after is not None and document["timestamp"] == after[0] and \
+                (document["tweet_id"], document["topic"]) <= after[1:]:
+            continue
+        yield {field: document.get(field) for field in TWEET_DOCUMENT_FIELDS}
+        nb_documents += 1
+        if limit is not None and nb_documents >= limit:
+            return
+
+
+class TweetColumns:
+    """
+    Parallel arrays of the tweet fields that summaries need, loaded with a projection
+    instead of building a Tweet per document.
+    """
+    PROJECTION = {"_id": 0, "sentiment.pos": 1, "sentiment.neg": 1, "sentiment.compound": 1,
+                  "region_id": 1, "topic": 1}
+
+    def __init__(self, positive=None, negative=None, compound=None, region_ids=None, topics=None):
+        self.positive = positive if positive is not None else []
+        self.negative = negative if negative is not None else []
+        self.compound = compound if compound is not None else []
+        self.region_ids = region_ids if region_ids is not None else []
+        self.topics = topics if topics is not None else []
+
+    def __len__(self):
+        return len(self.compound)
+
+    def append(self, document):
+        """
+        Add a projected tweet document. Documents without a stored sentiment are skipped,
+        as read paths never classify tweets.
+        """
+        tweet_sentiment = document.get("sentiment")
+        if tweet_sentiment is None:
+            # Imported here, as helpers.tweet can still be partially initialized when processing.data is imported.
+            from helpers.tweet import count_classification
+            count_classification("skipped")
+            return
+        self.positive.append(tweet_sentiment["pos"])
+        self.negative.append(tweet_sentiment["neg"])
+        self.compound.append(tweet_sentiment["compound"])
+        self.region_ids.append(document.get("region_id"))
+        self.topics.append(document.get("topic"))
+
+    def get_sentiment_arrays(self):
+        return (np.asarray(self.positive, dtype=float), np.asarray(self.negative, dtype=float),
+                np.asarray(self.compound, dtype=float))
+
+
+def get_tweet_columns(query):
+    logging.info("Getting tweet columns for query: {}".format(query))
+    start_time = time.time()
+    columns = TweetColumns()
+    for document in analytics_db.tweets.find(query, TweetColumns.PROJECTION):
+        columns.append(document)
+    logging.info("Loaded {} tweets in {} seconds".format(len(columns), time.time() - start_time))
+    return columns
 
 
 def get_all_topics():
     logging.info("Getting all topics")
-    res = db.tweets.distinct('topic', {})
+    res = analytics_db.tweets.distinct('topic', {})
     logging.info("Result size: {}".format(len(res)))
     res = [x for x in res if x is not None]
     return res
@@ -67,6 +196,8 @@ def get_all_topics():
 
 def get_current_topics():
     interval = get_last_interval()
+    if interval is None:
+        return []
     return get_interval_topics(interval)
 
 
@@ -80,7 +211,14 @@ def parse_interval_string(interval_string):
 
 
 def get_interval_topics(interval):
-    return list({tweet.topic for tweet in get_tweets_in_interval(interval)})
+    if summaries.covers_interval(interval):
+        return analytics_db.summaries.distinct('topic', get_summaries_interval_filter(interval))
+    return analytics_db.tweets.distinct('topic', get_interval_filter(interval))
+
+
+def get_summary_documents(query):
+    logging.info("Getting summaries for query: {}".format(query))
+    return analytics_db.summaries.find(query, {"_id": 0})
 
 
 class TweetsSummary:
@@ -125,97 +263,267 @@ class TweetsSummary:
         }
 
     def add_contributions(self, parent_summaries):
-        total_sentiment = self.average_sentiment
-        total_weight = 1
+        contribution = SummaryContribution()
         for summary_descendants in parent_summaries:
-            summary = summary_descendants[0]
-            nb_descendants = summary_descendants[1]
-            total_weight += summary.popularity / nb_descendants
-            self.nb_positive += summary.nb_positive / nb_descendants
-            self.nb_neutral += summary.nb_neutral / nb_descendants
-            self.nb_negative += summary.nb_negative / nb_descendants
-            self.popularity += summary.popularity / nb_descendants
-            total_sentiment += summary.average_sentiment / nb_descendants * summary.popularity
-        self.average_sentiment = total_sentiment / total_weight
-
-
-def get_tweets_summary(tweets):
-    popularity = len(tweets)
-    nb_positive = sum([1 for tweet in tweets if tweet.positive_sentiment()])
-    nb_negative = sum([1 for tweet in tweets if tweet.negative_sentiment()])
-    nb_neutral = sum([1 for tweet in tweets if tweet.neutral_sentiment()])
-    sentiments = [tweet.get_compound_sentiment() for tweet in tweets]
+            contribution = contribution.add(SummaryContribution.from_summary(*summary_descendants))
+        self.apply_contribution(contribution)
+
+    def apply_contribution(self, contribution):
+        total_weight = 1 + contribution.popularity
+        self.nb_positive += contribution.nb_positive
+        self.nb_neutral += contribution.nb_neutral
+        self.nb_negative += contribution.nb_negative
+        self.popularity += contribution.popularity
+        self.average_sentiment = (self.average_sentiment + contribution.sentiment_sum) / total_weight
+
+
+class SummaryContribution:
+    """
+    Share of ancestor region summaries that is added to a leaf region:
+    each ancestor summary is spread evenly over its leaf descendants.
+    """
+
+    def __init__(self, popularity=0, nb_positive=0, nb_negative=0, nb_neutral=0, sentiment_sum=0):
+        self.popularity = popularity
+        self.nb_positive = nb_positive
+        self.nb_negative = nb_negative
+        self.nb_neutral = nb_neutral
+        self.sentiment_sum = sentiment_sum
+
+    @classmethod
+    def from_summary(cls, summary, nb_descendants):
+        return SummaryContribution(
+            popularity=summary.popularity / nb_descendants,
+            nb_positive=summary.nb_positive / nb_descendants,
+            nb_negative=summary.nb_negative / nb_descendants,
+            nb_neutral=summary.nb_neutral / nb_descendants,
+            sentiment_sum=summary.average_sentiment / nb_descendants * summary.popularity
+        )
+
+    def add(self, other):
+        return SummaryContribution(
+            popularity=self.popularity + other.popularity,
+            nb_positive=self.nb_positive + other.nb_positive,
+            nb_negative=self.nb_negative + other.nb_negative,
+            nb_neutral=self.nb_neutral + other.nb_neutral,
+            sentiment_sum=self.sentiment_sum + other.sentiment_sum
+        )
+
+
+def get_ancestor_contributions(region_data):
+    """
+    Sum the contributions of all ancestors of every region in a single top-down pass over the regions in preorder.
+    :param region_data: Dictionary from region id to the TweetsSummary of the tweets located in exactly that region.
+    :return: Dictionary from region id to SummaryContribution.
+    """
+    contributions = dict()
+    for region_id in regions.get_preorder_region_ids():
+        parent = regions.get_region_by_id(region_id).get_parent()
+        if parent is None:
+            contributions[region_id] = SummaryContribution()
+            continue
+        parent_contribution = SummaryContribution.from_summary(
+            region_data.get(parent.region_id, TweetsSummary()), parent.get_number_of_leaf_descendants())
+        contributions[region_id] = contributions[parent.region_id].add(parent_contribution)
+    return contributions
+
+
+def get_totals_summary(documents):
+    """
+    Combine rollup documents into a single TweetsSummary.
+    """
+    totals = dict.fromkeys(summaries.SUMMARY_FIELDS, 0)
+    for document in documents:
+        for field in summaries.SUMMARY_FIELDS:
+            totals[field] += document[field]
     average_sentiment = 0
-    if len(tweets) > 0:
-        average_sentiment = sum(sentiments) / len(sentiments)
+    if totals["popularity"] > 0:
+        average_sentiment = totals["sentiment_sum"] / totals["popularity"]
+    return TweetsSummary(
+        popularity=totals["popularity"],
+        nb_positive=totals["nb_positive"],
+        nb_negative=totals["nb_negative"],
+        nb_neutral=totals["nb_neutral"],
+        average_sentiment=average_sentiment
+    )
+
+
+def group_summary_documents(documents, key):
+    groups = dict()
+    for document in documents:
+        groups.setdefault(document[key], []).append(document)
+    return {group_key: get_totals_summary(group) for group_key, group in groups.items()}
+
+
+def get_sentiment_classes(positive, negative):
+    """
+    :return: Array with 0 for negative, 1 for neutral and 2 for positive tweets.
+    """
+    return (positive > negative).astype(np.int64) - (negative > positive).astype(np.int64) + 1
+
+
+def get_arrays_summary(positive, negative, compound):
+    popularity = len(compound)
+    nb_negative, nb_neutral, nb_positive = np.bincount(get_sentiment_classes(positive, negative), minlength=3)
+    average_sentiment = 0
+    if popularity > 0:
+        average_sentiment = float(compound.mean())
 
     return TweetsSummary(
         popularity=popularity,
-        nb_positive=nb_positive,
-        nb_negative=nb_negative,
-        nb_neutral=nb_neutral,
+        nb_positive=int(nb_positive),
+        nb_negative=int(nb_negative),
+        nb_neutral=int(nb_neutral),
         average_sentiment=average_sentiment
     )
 
 
+def get_grouped_arrays_summaries(keys, positive, negative, compound):
+    """
+    Summarize tweets per key with bincount reductions instead of filtering the tweets once per key.
+    :return: Dictionary from key to TweetsSummary, for the keys that have tweets.
+    """
+    key_codes = dict()
+    codes = np.fromiter((key_codes.setdefault(key, len(key_codes)) for key in keys), dtype=np.int64,
+                        count=len(keys))
+    nb_keys = len(key_codes)
+    if nb_keys == 0:
+        # numpy 1.12 rejects minlength=0.
+        return dict()
+    popularities = np.bincount(codes, minlength=nb_keys)
+    sentiment_sums = np.bincount(codes, weights=compound, minlength=nb_keys)
+    class_counts = np.bincount(codes * 3 + get_sentiment_classes(positive, negative),
+                               minlength=nb_keys * 3).reshape(nb_keys, 3)
+    return {
+        key: TweetsSummary(
+            popularity=int(popularities[code]),
+            nb_positive=int(class_counts[code, 2]),
+            nb_negative=int(class_counts[code, 0]),
+            nb_neutral=int(class_counts[code, 1]),
+            average_sentiment=float(sentiment_sums[code] / popularities[code])
+        )
+        for key, code in key_codes.items()
+    }
+
+
+def get_tweets_summary(columns):
+    """
+    :param columns: TweetColumns of the tweets to summarize.
+    """
+    return get_arrays_summary(*columns.get_sentiment_arrays())
+
+
+def get_grouped_tweets_summaries(columns, key_column):
+    """
+    :param key_column: Column of columns to group by, "topics" or "region_ids".
+    """
+    return get_grouped_arrays_summaries(getattr(columns, key_column), *columns.get_sentiment_arrays())
+
+
 def get_interval_topics_details(interval):
     # logging.info("get_interval_topics_details!")
-    topics = get_interval_topics(interval)
-    all_tweets = get_tweets_in_interval(interval)
-    topic_data = dict()
-    for topic in topics:
-        # tweets = get_tweets_in_interval_for_topic(interval, topic)
-        tweets = [tweet for tweet in all_tweets if tweet.topic == topic]
-        topic_data[topic] = get_tweets_summary(tweets)
-    return topic_data
+    if summaries.covers_interval(interval):
+        documents = get_summary_documents(get_summaries_interval_filter(interval))
+        return group_summary_documents(documents, "topic")
+    all_tweets = get_tweet_columns(get_interval_filter(interval))
+    return get_grouped_tweets_summaries(all_tweets, "topics")
+
+
+def get_rollup_evolution(intervals, query):
+    """
+    Summarize rollup documents matching query per interval, with a single query over all intervals.
+    """
+    intervals = sorted(intervals)
+    starts = [interval[0].timestamp() for interval in intervals]
+    query = dict(query)
+    query["interval_start"] = {"$gte": starts[0], "$lt": intervals[-1][1].timestamp()}
+    interval_documents = {interval: [] for interval in intervals}
+    for document in get_summary_documents(query):
+        position = bisect.bisect_right(starts, document["interval_start"]) - 1
+        interval = intervals[position]
+        if document["interval_start"] < interval[1].timestamp():
+            interval_documents[interval].append(document)
+    return {interval: get_totals_summary(documents) for interval, documents in interval_documents.items()}
+
+
+def get_evolution_pipeline(intervals, query):
+    """
+    The interval boundaries are used as $bucket boundaries, so each interval maps to the bucket
+    starting at its start. Buckets for gaps between intervals are ignored.
+    """
+    boundaries = sorted({timestamp for interval in intervals
+                         for timestamp in (interval[0].timestamp(), interval[1].timestamp())})
+    match = dict(query)
+    match["timestamp"] = {"$gte": boundaries[0], "$lt": boundaries[-1]}
+    return [
+        {"$match": match},
+        {"$bucket": {"groupBy": "$timestamp", "boundaries": boundaries, "output": summaries.SENTIMENT_ACCUMULATORS}}
+    ]
+
+
+def get_aggregated_evolution(intervals, query):
+    """
+    Summarize tweets matching query per interval in a single server-side aggregation, see get_evolution_pipeline.
+    """
+    if len(intervals) == 0:
+        return dict()
+    pipeline = get_evolution_pipeline(intervals, query)
+    logging.info("Aggregating tweets per interval for query: {}".format(query))
+    buckets = {bucket["_id"]: bucket for bucket in analytics_db.tweets.aggregate(pipeline)}
+    return {
+        interval: get_totals_summary([buckets[interval[0].timestamp()]] if interval[0].timestamp() in buckets else [])
+        for interval in intervals
+    }
 
 
 def get_global_topic_evolution(topic_id):
-    interval_data = dict()
-    for interval in get_intervals():
-        tweets = get_tweets_in_interval_for_topic(interval, topic_id)
-        interval_data[interval] = get_tweets_summary(tweets)
-    return interval_data
+    intervals = get_intervals()
+    if summaries.covers_intervals(intervals):
+        return get_rollup_evolution(intervals, get_topic_filter(topic_id))
+    return get_aggregated_evolution(intervals, get_topic_filter(topic_id))
 
 
 def get_topic_location_evolution(topic_id, location_id):
-    interval_data = dict()
-    for interval in get_intervals():
-        tweets = get_tweets_in_interval_region_topic(interval, location_id, topic_id)
-        interval_data[interval] = get_tweets_summary(tweets)
-    return interval_data
+    intervals = get_intervals()
+    query = dict()
+    query.update(get_children_locations_filter(location_id))
+    query.update(get_topic_filter(topic_id))
+    if summaries.covers_intervals(intervals):
+        return get_rollup_evolution(intervals, query)
+    return get_aggregated_evolution(intervals, query)
 
 
 def get_topic_interval_data_per_region(topic_id, interval):
-    all_regions = regions.get_all_regions()
-    leaf_regions = [region for region in all_regions if region.is_leaf()]
-    non_leaf_regions = [region for region in all_regions if not region.is_leaf()]
-
-    all_tweets = get_tweets_in_interval_for_topic(interval, topic_id)
-
-    non_leaf_start = time.time()
-    parent_data = dict()
-    for region in non_leaf_regions:
-        tweets = [t for t in all_tweets if t.region_id == region.region_id]
-        parent_data[region.region_id] = get_tweets_summary(tweets)
-    non_leaf_end = time.time()
+    leaf_regions = [region for region in regions.get_all_regions() if region.is_leaf()]
+
+    group_start = time.time()
+    if summaries.covers_interval(interval):
+        query = get_summaries_interval_filter(interval)
+        query.update(get_topic_filter(topic_id))
+        grouped_data = group_summary_documents(get_summary_documents(query), "region_id")
+    else:
+        all_tweets = get_tweet_columns(get_interval_topic_query(interval, topic_id))
+        grouped_data = get_grouped_tweets_summaries(all_tweets, "region_ids")
+    contributions = get_ancestor_contributions(grouped_data)
+    group_end = time.time()
 
     region_data = dict()
     for region in leaf_regions:
-        tweets = [t for t in all_tweets if t.region_id == region.region_id]
-        total_summary = get_tweets_summary(tweets)
-        parent_contributions = [
-            (parent_data[ancestor_region.region_id], ancestor_region.get_number_of_leaf_descendants()) for
-            ancestor_region in region.get_ancestors()]
-        total_summary.add_contributions(parent_contributions)
+        total_summary = grouped_data.get(region.region_id, TweetsSummary())
+        total_summary.apply_contribution(contributions[region.region_id])
         region_data[region.region_id] = total_summary
 
     leaf_end = time.time()
-    logging.info("Non-leaf regions: {} seconds".format(non_leaf_end - non_leaf_start))
-    logging.info("Leaf regions: {} seconds".format(leaf_end - non_leaf_end))
+    logging.info("Grouping and ancestor contributions: {} seconds".format(group_end - group_start))
+    logging.info("Leaf regions: {} seconds".format(leaf_end - group_end))
     return region_data
 
 
 def get_topic_interval_location_data(topic_id, interval, location_id):
-    tweets = get_tweets_in_interval_region_topic(topic=topic_id, interval=interval, location_id=location_id)
+    if summaries.covers_interval(interval):
+        query = get_summaries_interval_filter(interval)
+        query.update(get_topic_filter(topic_id))
+        query.update(get_children_locations_filter(location_id))
+        return get_totals_summary(get_summary_documents(query))
+    tweets = get_tweet_columns(get_interval_region_topic_query(interval, location_id, topic_id))
     return get_tweets_summary(tweets)
@@ -0,0 +1,149 @@
+"""
+MongoDB clients and database handles.
+Every process has one client with a bounded connection pool and timeouts, so that requests fail fast with 503 instead of
+hanging when MongoDB is slow. Handles with other options share its pool:
+- db: reads and writes with the default write concern, from the primary.
+- ingestion_db: writes of the ingestion pipeline, with the MONGO_INGESTION_W / MONGO_INGESTION_J write concern.
+- analytics_db: reads of the analytics endpoints, with the MONGO_ANALYTICS_READ_PREFERENCE read preference.
+  Secondaries may lag behind the ingestion watermark, so only use secondaries when a few seconds of lag are acceptable.
+- maintenance_db: index builds, summary rebuilds and the reclassification and cleanup scans, on a separate client
+  without socket timeout.
+"""
+
+import threading
+
+from pymongo import MongoClient, ReadPreference, WriteConcern, monitoring
+
+from main import app
+
+MONGO_MAX_POOL_SIZE = app.config['MONGO_MAX_POOL_SIZE'] if 'MONGO_MAX_POOL_SIZE' in app.config else 50
+# Time a thread waits for a free connection of the pool before failing, instead of waiting forever.
+MONGO_WAIT_QUEUE_TIMEOUT_MS = app.config['MONGO_WAIT_QUEUE_TIMEOUT_MS'] if 'MONGO_WAIT_QUEUE_TIMEOUT_MS' in app.config \
+    else 5000
+MONGO_CONNECT_TIMEOUT_MS = app.config['MONGO_CONNECT_TIMEOUT_MS'] if 'MONGO_CONNECT_TIMEOUT_MS' in app.config \
+    else 5000
+MONGO_SERVER_SELECTION_TIMEOUT_MS = app.config['MONGO_SERVER_SELECTION_TIMEOUT_MS'] \
+    if 'MONGO_SERVER_SELECTION_TIMEOUT_MS' in app.config else 5000
+MONGO_SOCKET_TIMEOUT_MS = app.config['MONGO_SOCKET_TIMEOUT_MS'] if 'MONGO_SOCKET_TIMEOUT_MS' in app.config else 30000
+# None waits as long as the operation takes.
+MONGO_MAINTENANCE_SOCKET_TIMEOUT_MS = app.config['MONGO_MAINTENANCE_SOCKET_TIMEOUT_MS'] \
+    if 'MONGO_MAINTENANCE_SOCKET_TIMEOUT_MS' in app.config else None
+MONGO_INGESTION_W = app.config['MONGO_INGESTION_W'] if 'MONGO_INGESTION_W' in app.config else 1
+MONGO_INGESTION_J = app.config['MONGO_INGESTION_J'] if 'MONGO_INGESTION_J' in app.config else False
+MONGO_ANALYTICS_READ_PREFERENCE = app.config['MONGO_ANALYTICS_READ_PREFERENCE'] \
+    if 'MONGO_ANALYTICS_READ_PREFERENCE' in app.config else "primary"
+
+DATABASE_NAME = "database"
+
+READ_PREFERENCES = {
+    "primary": ReadPreference.PRIMARY,
+    "primaryPreferred": ReadPreference.PRIMARY_PREFERRED,
+    "secondary": ReadPreference.SECONDARY,
+    "secondaryPreferred": ReadPreference.SECONDARY_PREFERRED,
+    "nearest": ReadPreference.NEAREST,
+}
+
+
+class PoolMonitor(monitoring.CommandListener):
+    """
+    Tracks the commands in flight on a client. Every command in flight holds a connection of the pool,
+    so their number is the number of connections in use.
+    """
+
+    def __init__(self, max_pool_size):
+        self.max_pool_size = max_pool_size
+        self.lock = threading.Lock()
+        self.in_use = 0
+        self.peak_in_use = 0
+        self.nb_commands = 0
+        self.nb_failed = 0
+        self.nb_unavailable = 0
+        self.total_duration = 0
+
+    def started(self, event):
+        with self.lock:
+            self.in_use += 1
+            self.peak_in_use = max(self.peak_in_use, self.in_use)
+
+    def succeeded(self, event):
+        self.finish(event.duration_micros, failed=False)
+
+    def failed(self, event):
+        self.finish(event.duration_micros, failed=True)
+
+    def finish(self, duration_micros, failed):
+        with self.lock:
+            self.in_use = max(self.in_use - 1, 0)
+            self.nb_commands += 1
+            self.nb_failed += int(failed)
+            self.total_duration += duration_micros / 1e6
+
+    def record_unavailable(self):
+        """
+        Count an operation that failed because no connection or server was available in time.
+        """
+        with self.lock:
+            self.nb_unavailable += 1
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                "max_pool_size": self.max_pool_size,
+                "in_use": self.in_use,
+                "peak_in_use": self.peak_in_use,
+                "utilisation": float(self.in_use) / self.max_pool_size if self.max_pool_size else 0,
+                "commands": self.nb_commands,
+                "failed": self.nb_failed,
+                "unavailable": self.nb_unavailable,
+                "mean_duration": self.total_duration / self.nb_commands if self.nb_commands > 0 else 0
+            }
+
+
+pool_monitor = PoolMonitor(MONGO_MAX_POOL_SIZE)
+
+
+def create_mongo_client(socket_timeout_ms=MONGO_SOCKET_TIMEOUT_MS, monitor=None):
+    """
+    MongoClient is not fork-safe, processes forked by a pool create their own client.
+    The client only connects on its first operation, so that WSGI workers forked from a preloaded master
+    open their own connections.
+    """
+    return MongoClient(
+        app.config['MONGO_HOST'], app.config['MONGO_PORT'],
+        connect=False,
+        maxPoolSize=MONGO_MAX_POOL_SIZE,
+        waitQueueTimeoutMS=MONGO_WAIT_QUEUE_TIMEOUT_MS,
+        connectTimeoutMS=MONGO_CONNECT_TIMEOUT_MS,
+        serverSelectionTimeoutMS=MONGO_SERVER_SELECTION_TIMEOUT_MS,
+        socketTimeoutMS=socket_timeout_ms,
+        event_listeners=[monitor] if monitor is not None else []
+    )
+
+
+def get_read_preference(name):
+    if name not in READ_PREFERENCES:
+        raise ValueError("Unknown read preference {}, expected one of {}".format(name, sorted(READ_PREFERENCES)))
+    return READ_PREFERENCES[name]
+
+
+mongo = create_mongo_client(monitor=pool_monitor)
+db = mongo[DATABASE_NAME]
+ingestion_db = mongo.get_database(DATABASE_NAME, write_concern=WriteConcern(w=MONGO_INGESTION_W,
+                                                                            j=MONGO_INGESTION_J))
+analytics_db = mongo.get_database(DATABASE_NAME,
+                                  read_preference=get_read_preference(MONGO_ANALYTICS_READ_PREFERENCE))
+
+maintenance_mongo = create_mongo_client(socket_timeout_ms=MONGO_MAINTENANCE_SOCKET_TIMEOUT_MS)
+maintenance_db = maintenance_mongo[DATABASE_NAME]
+
+
+def close_mongo_clients():
+    """
+    Disconnect, e.g. before forking, the clients reconnect on their next operation.
+    """
+    mongo.close()
+    maintenance_mongo.close()
+
+
+def get_pool_stats():
+    return pool_monitor.get_stats()
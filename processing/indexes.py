@@ -0,0 +1,153 @@
+"""
+Indexes needed by the query shapes in processing.data and processing.update.
+create_indexes is idempotent and runs at startup; explain_query_shapes checks that no query shape
+falls back to a collection scan.
+"""
+
+import logging
+
+from bson.son import SON
+from pymongo import ASCENDING, errors
+
+from processing import maintenance_db
+
+INDEXES = {
+    "tweets": [
+        # Deduplication of ingested tweets, one document per tweet and topic.
+        {"keys": [("tweet_id", ASCENDING), ("topic", ASCENDING)], "unique": True},
+        # Interval filters, the earliest tweet lookup and the download order.
+        {"keys": [("timestamp", ASCENDING), ("tweet_id", ASCENDING), ("topic", ASCENDING)]},
+        # Interval and topic filters, distinct topics and the download order for a topic.
+        {"keys": [("topic", ASCENDING), ("timestamp", ASCENDING), ("tweet_id", ASCENDING)]},
+        # Interval, topic and sub-region filters.
+        {"keys": [("region_id", ASCENDING), ("topic", ASCENDING), ("timestamp", ASCENDING), ("tweet_id", ASCENDING)]},
+    ],
+    "summaries": [
+        # One rollup document per bucket, topic and region, interval filters.
+        {"keys": [("interval_start", ASCENDING), ("topic", ASCENDING), ("region_id", ASCENDING)], "unique": True},
+        # Topic evolution and topic filters.
+        {"keys": [("topic", ASCENDING), ("interval_start", ASCENDING)]},
+    ],
+}
+
+# Indexes created by earlier versions that the indexes above replace, they would only add write cost.
+REPLACED_INDEXES = {
+    "tweets": ["tweet_id_1", "timestamp_1", "topic_1_timestamp_1", "region_id_1_topic_1_timestamp_1"],
+}
+
+INDEX_NOT_FOUND_ERROR = 27
+
+indexes_created = False
+
+
+def create_indexes():
+    global indexes_created
+    nb_failures = 0
+    for collection_name, indexes in INDEXES.items():
+        for index in indexes:
+            try:
+                # In the background, so that building an index over existing tweets does not block the database.
+                maintenance_db[collection_name].create_index(index["keys"], unique=index.get("unique", False),
+                                                             background=True)
+            except errors.DuplicateKeyError as err:
+                nb_failures += 1
+                logging.error("Failed to create a unique index: {}".format(err))
+    indexes_created = nb_failures == 0
+    drop_replaced_indexes()
+    logging.info("Indexes are up to date")
+
+
+def drop_replaced_indexes():
+    """
+    Drop the replaced indexes once their replacements are built.
+    The web process and the ingestion service both run this at startup, the other one may drop an index first.
+    """
+    for collection_name, index_names in REPLACED_INDEXES.items():
+        existing_indexes = maintenance_db[collection_name].index_information()
+        for index_name in index_names:
+            if index_name in existing_indexes:
+                logging.info("Dropping replaced index {} of {}".format(index_name, collection_name))
+                try:
+                    maintenance_db[collection_name].drop_index(index_name)
+                except errors.OperationFailure as err:
+                    if err.code != INDEX_NOT_FOUND_ERROR:
+                        raise
+
+
+def make_command(command_name, collection_name, **options):
+    """
+    The command name must be the first key, which plain dicts do not guarantee before Python 3.6.
+    """
+    command = SON([(command_name, collection_name)])
+    command.update(options)
+    return command
+
+
+def get_query_shapes(interval, topic, location_id):
+    """
+    :return: List of (name, explain command) for every query shape used by the query helpers.
+    """
+    from processing import data
+
+    tweets_interval = data.get_interval_filter(interval)
+    tweets_topic = data.get_interval_topic_query(interval, topic)
+    tweets_region_topic = data.get_interval_region_topic_query(interval, location_id, topic)
+    summaries_interval = data.get_summaries_interval_filter(interval)
+    summaries_topic = dict(summaries_interval)
+    summaries_topic.update(data.get_topic_filter(topic))
+    evolution_region_query = dict(data.get_children_locations_filter(location_id))
+    evolution_region_query.update(data.get_topic_filter(topic))
+    download_topic = data.get_download_query(interval, topic)
+    download_region_topic = data.get_download_query(interval, topic, location_id)
+    evolution_pipeline = data.get_evolution_pipeline([interval], data.get_topic_filter(topic))
+    evolution_region_pipeline = data.get_evolution_pipeline([interval], evolution_region_query)
+    return [
+        ("get_tweets_in_interval", make_command("find", "tweets", filter=tweets_interval)),
+        ("get_tweets_in_interval_for_topic", make_command("find", "tweets", filter=tweets_topic)),
+        ("get_tweets_in_interval_region_topic", make_command("find", "tweets", filter=tweets_region_topic)),
+        ("get_all_topics", make_command("distinct", "tweets", key="topic", query={})),
+        ("get_interval_topics", make_command("distinct", "tweets", key="topic", query=tweets_interval)),
+        ("get_earliest_time", make_command("find", "tweets", filter={}, sort={"timestamp": 1}, limit=1)),
+        ("get_aggregated_evolution", make_command("aggregate", "tweets", pipeline=evolution_pipeline)),
+        ("get_aggregated_evolution (region)", make_command("aggregate", "tweets", pipeline=evolution_region_pipeline)),
+        ("iter_tweet_documents", make_command("find", "tweets", filter=tweets_interval,
+                                              sort=SON(data.get_download_sort()))),
+        ("iter_tweet_documents (topic)", make_command("find", "tweets", filter=download_topic,
+                                                      sort=SON(data.get_download_sort(topic)))),
+        ("iter_tweet_documents (region, topic)", make_command("find", "tweets", filter=download_region_topic,
+                                                              sort=SON(data.get_download_sort(topic)))),
+        ("get_interval_topics (summaries)", make_command("distinct", "summaries", key="topic",
+                                                         query=summaries_interval)),
+        ("get_interval_topics_details (summaries)", make_command("find", "summaries", filter=summaries_interval)),
+        ("get_topic_interval_data_per_region (summaries)", make_command("find", "summaries",
+                                                                        filter=summaries_topic)),
+    ]
+
+
+def find_stages(plan, stage):
+    """
+    :return: Whether the explain output contains the given stage, ignoring rejected plans.
+    """
+    if isinstance(plan, dict):
+        if plan.get("stage") == stage:
+            return True
+        return any(find_stages(value, stage) for key, value in plan.items() if key != "rejectedPlans")
+    if isinstance(plan, list):
+        return any(find_stages(value, stage) for value in plan)
+    return False
+
+
+def explain_query_shapes(interval, topic, location_id):
+    """
+    :return: List of (name, whether the query shape does a collection scan).
+    """
+    results = []
+    for name, command in get_query_shapes(interval, topic, location_id):
+        if "aggregate" in command:
+            # MongoDB 3.4 cannot explain aggregations with the explain command, they take an explain option instead.
+            explain = maintenance_db.command("aggregate", command["aggregate"], pipeline=command["pipeline"],
+                                             explain=True)
+        else:
+            explain = maintenance_db.command("explain", command, verbosity="queryPlanner")
+        results.append((name, find_stages(explain, "COLLSCAN")))
+    return results
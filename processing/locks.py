@@ -0,0 +1,107 @@
+"""
+Readers-writer lock shared between processes, kept in a document of the metadata collection:
+{"_id": "lock_<name>", "exclusive": {"owner": ..., "expires_at": ...}, "shared": {<owner>: <expires at>}}.
+Holders take a lease that expires after LOCK_TTL seconds unless renewed, so a crashed process does not keep the lock.
+"""
+
+import contextlib
+import logging
+import threading
+import time
+import uuid
+
+from pymongo import errors
+
+from main import app
+from processing import db
+
+LOCK_TTL = app.config['LOCK_TTL'] if 'LOCK_TTL' in app.config else 300  # seconds
+LOCK_POLL_INTERVAL = 1  # seconds
+
+
+class SharedLock:
+    """
+    Shared holders run concurrently. The exclusive holder blocks new shared holders, then waits until the current ones
+    released the lock or their lease expired.
+    """
+
+    def __init__(self, name, ttl=LOCK_TTL, poll_interval=LOCK_POLL_INTERVAL):
+        self.name = name
+        self.key = "lock_{}".format(name)
+        self.ttl = ttl
+        self.poll_interval = poll_interval
+
+    def get_exclusive_free_filter(self, owner=None):
+        free = [{"exclusive": None}, {"exclusive.expires_at": {"$lt": time.time()}}]
+        if owner is not None:
+            free.append({"exclusive.owner": owner})
+        return {"_id": self.key, "$or": free}
+
+    def try_acquire(self, update, owner=None):
+        """
+        Apply update to the lock document if no other process holds the exclusive lease. When the filter does not
+        match, the upsert tries to insert a second document with the same _id and fails.
+        """
+        try:
+            db.metadata.update_one(self.get_exclusive_free_filter(owner), update, upsert=True)
+            return True
+        except errors.DuplicateKeyError:
+            return False
+
+    def try_acquire_shared(self, owner):
+        return self.try_acquire({"$set": {"shared." + owner: time.time() + self.ttl}})
+
+    def release_shared(self, owner):
+        db.metadata.update_one({"_id": self.key}, {"$unset": {"shared." + owner: ""}})
+
+    def try_acquire_exclusive(self, owner):
+        return self.try_acquire({"$set": {"exclusive": {"owner": owner, "expires_at": time.time() + self.ttl}}},
+                                owner)
+
+    def release_exclusive(self, owner):
+        db.metadata.update_one({"_id": self.key, "exclusive.owner": owner}, {"$unset": {"exclusive": ""}})
+
+    def get_nb_shared_holders(self):
+        document = db.metadata.find_one({"_id": self.key})
+        if document is None:
+            return 0
+        now = time.time()
+        return sum(1 for expires_at in document.get("shared", {}).values() if expires_at > now)
+
+    @contextlib.contextmanager
+    def shared(self):
+        owner = uuid.uuid4().hex
+        if not self.try_acquire_shared(owner):
+            logging.info("Waiting for the exclusive holder of the {} lock".format(self.name))
+            while not self.try_acquire_shared(owner):
+                time.sleep(self.poll_interval)
+        try:
+            yield
+        finally:
+            self.release_shared(owner)
+
+    @contextlib.contextmanager
+    def exclusive(self):
+        owner = uuid.uuid4().hex
+        while not self.try_acquire_exclusive(owner):
+            logging.info("Waiting for the exclusive holder of the {} lock".format(self.name))
+            time.sleep(self.poll_interval)
+        stop_renewing = threading.Event()
+        renewer = threading.Thread(target=self.renew_exclusive, args=(owner, stop_renewing),
+                                   name="{}-lock".format(self.name), daemon=True)
+        renewer.start()
+        try:
+            while self.get_nb_shared_holders() > 0:
+                logging.info("Waiting for the shared holders of the {} lock".format(self.name))
+                time.sleep(self.poll_interval)
+            yield
+        finally:
+            stop_renewing.set()
+            renewer.join()
+            self.release_exclusive(owner)
+
+    def renew_exclusive(self, owner, stop_renewing):
+        while not stop_renewing.wait(self.ttl / 3):
+            if not self.try_acquire_exclusive(owner):
+                logging.error("Lost the exclusive lease of the {} lock".format(self.name))
+                return
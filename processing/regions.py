@@ -1,6 +1,21 @@
+import hashlib
 import json
+import logging
+import numbers
+import os
+import threading
 
+from shapely import wkb
 from shapely.geometry import Point, shape
+from shapely.prepared import prep
+from shapely.strtree import STRtree
+
+from main import app
+
+REGIONS_GEOJSON_FILE = 'data/GBR_GeoJSON.json'
+REGIONS_CACHE_FILE = app.config['REGIONS_CACHE_FILE'] if 'REGIONS_CACHE_FILE' in app.config \
+    else 'output/regions.cache'
+REGIONS_CACHE_VERSION = 2
 
 
 class Region:
@@ -13,12 +28,19 @@ class Region:
         self.region_id = region_id
         self.parent_id = parent_id
         self.shape = None
-        self.nb_leaf_descendants = None
+        self.prepared_shape = None
+        # Hierarchy tables, filled in by build_region_hierarchy().
+        self.parent = None
+        self.children = []
+        self.ancestors = []
         self.leaf = None
-        self.sub_region_ids = None
+        self.nb_leaf_descendants = None
+        self.preorder_start = None
+        self.preorder_end = None
 
     def set_shape(self, region_shape):
         self.shape = region_shape
+        self.prepared_shape = prep(region_shape)
 
     def has_shape(self):
         return self.shape is not None
@@ -26,49 +48,79 @@ class Region:
     def contains_point(self, point):
         if not self.has_shape():
             return False
-        return self.shape.contains(point)
+        return self.prepared_shape.contains(point)
 
     def get_parent(self):
-        for region in get_all_regions():
-            if region.region_id == self.parent_id:
-                return region
-        return None
+        return self.parent
+
+    def get_children(self):
+        return list(self.children)
 
     def get_number_of_leaf_descendants(self):
-        if self.nb_leaf_descendants is None:
-            self.nb_leaf_descendants = len(
-                list(filter(lambda r: r.is_leaf(), map(get_region_by_id, self.get_all_sub_region_ids()))))
         return self.nb_leaf_descendants
 
     def get_all_sub_region_ids(self):
-        if self.sub_region_ids is None:
-            self.sub_region_ids = set()
-            for region in get_all_regions():
-                if is_in_region(region, get_region_by_id(self.region_id)):
-                    self.sub_region_ids.add(region.region_id)
-        return set(self.sub_region_ids)
+        return list(regions_preorder_ids[self.preorder_start:self.preorder_end])
 
     def get_ancestors(self):
-        res = []
-        current = self.get_parent()
-        while current is not None:
-            res.append(current)
-            current = current.get_parent()
-        return res
+        return list(self.ancestors)
 
     def is_leaf(self):
-        if self.leaf is None:
-            self.leaf = not any(region.parent_id == self.region_id for region in get_all_regions())
         return self.leaf
 
+    def contains_region(self, region):
+        """
+        :return: Whether region is this region or one of its descendants, using the preorder ranges.
+        """
+        return self.preorder_start <= region.preorder_start < self.preorder_end
+
 
 all_regions_dict = dict()
+regions_preorder_ids = []
+shaped_regions = []
+shaped_regions_positions = dict()
+shaped_regions_tree = None
+
+
+regions_loaded = False
+regions_lock = threading.Lock()
+
+
+def ensure_regions_loaded():
+    """
+    Load the regions on first use instead of on import, so that processes which do not locate tweets start quickly.
+    """
+    if regions_loaded:
+        return
+    with regions_lock:
+        if not regions_loaded:
+            load_regions()
+
+
+def get_geojson_hash():
+    with open(REGIONS_GEOJSON_FILE, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
 
 
 def load_regions():
+    """
+    Load the regions from the precompiled cache if it was built from the current GeoJSON file,
+    otherwise parse the GeoJSON file and rebuild the cache.
+    """
+    global regions_loaded
+    geojson_hash = get_geojson_hash()
+    if not load_regions_cache(geojson_hash):
+        load_regions_geojson()
+        save_regions_cache(geojson_hash)
+    build_region_hierarchy()
+    build_spatial_index()
+    regions_loaded = True
+
+
+def load_regions_geojson():
     global all_regions_dict
     all_regions_dict = dict()
-    with open('data/GBR_GeoJSON.json', 'r', encoding="utf-8") as f:
+    with open(REGIONS_GEOJSON_FILE, 'r', encoding="utf-8") as f:
         gbr_data = json.load(f)
         regions_data = gbr_data["features"]
         for region_data in regions_data:
@@ -97,25 +149,142 @@ def load_regions():
             all_regions_dict[leaf_id].set_shape(shape(region_data['geometry']))
 
 
-if len(all_regions_dict) == 0:
-    load_regions()
+def load_regions_cache(geojson_hash):
+    """
+    The cache starts with a line of JSON holding the version, the hash of the GeoJSON file it was built from and the
+    regions in the order of get_all_regions(), as [name, region id, parent id, size of the WKB shape or null].
+    The WKB shapes follow, concatenated in the same order.
+    :return: Whether the regions were loaded from the cache.
+    """
+    global all_regions_dict
+    try:
+        with open(REGIONS_CACHE_FILE, 'rb') as f:
+            header = json.loads(f.readline().decode("utf-8"))
+            if header.get("version") != REGIONS_CACHE_VERSION or header.get("geojson_hash") != geojson_hash:
+                logging.info("Regions cache {} is out of date".format(REGIONS_CACHE_FILE))
+                return False
+            regions_dict = dict()
+            for name, region_id, parent_id, shape_size in header["regions"]:
+                region = Region(name, region_id, parent_id)
+                if shape_size is not None:
+                    shape_wkb = f.read(shape_size)
+                    if len(shape_wkb) != shape_size:
+                        raise ValueError("truncated shape for region {}".format(region_id))
+                    region.set_shape(wkb.loads(shape_wkb))
+                regions_dict[region_id] = region
+    except FileNotFoundError:
+        return False
+    except Exception as ex:
+        logging.warning("Ignoring unreadable regions cache {}: {}".format(REGIONS_CACHE_FILE, ex))
+        return False
+    all_regions_dict = regions_dict
+    return True
+
+
+def save_regions_cache(geojson_hash):
+    regions_data = []
+    shapes_wkb = []
+    for region in all_regions_dict.values():
+        shape_wkb = wkb.dumps(region.shape) if region.has_shape() else None
+        regions_data.append([region.name, region.region_id, region.parent_id,
+                             len(shape_wkb) if shape_wkb is not None else None])
+        if shape_wkb is not None:
+            shapes_wkb.append(shape_wkb)
+    header = {"version": REGIONS_CACHE_VERSION, "geojson_hash": geojson_hash, "regions": regions_data}
+    # Write to a temporary file first, so that concurrent processes never read a partial cache.
+    temporary_file = "{}.{}".format(REGIONS_CACHE_FILE, os.getpid())
+    try:
+        with open(temporary_file, 'wb') as f:
+            f.write(json.dumps(header).encode("utf-8"))
+            f.write(b"\n")
+            for shape_wkb in shapes_wkb:
+                f.write(shape_wkb)
+        os.replace(temporary_file, REGIONS_CACHE_FILE)
+    except OSError as ex:
+        logging.warning("Failed to write regions cache {}: {}".format(REGIONS_CACHE_FILE, ex))
+
+
+def build_region_hierarchy():
+    """
+    Precompute parent pointers, children, ancestor chains, leaf flags and leaf descendant counts.
+    Regions are numbered in preorder, so the sub-regions of a region are the contiguous range
+    regions_preorder_ids[preorder_start:preorder_end].
+    """
+    global regions_preorder_ids
+    roots = []
+    for region in all_regions_dict.values():
+        region.parent = all_regions_dict.get(region.parent_id)
+        region.children = []
+    for region in all_regions_dict.values():
+        if region.parent is None:
+            roots.append(region)
+        else:
+            region.parent.children.append(region)
+
+    regions_preorder_ids = []
+    stack = [(root, False) for root in reversed(roots)]
+    while len(stack) > 0:
+        region, visited = stack.pop()
+        if visited:
+            region.preorder_end = len(regions_preorder_ids)
+            region.nb_leaf_descendants = 1 if region.leaf else \
+                sum(child.nb_leaf_descendants for child in region.children)
+            continue
+        region.preorder_start = len(regions_preorder_ids)
+        regions_preorder_ids.append(region.region_id)
+        region.leaf = len(region.children) == 0
+        region.ancestors = [] if region.parent is None else [region.parent] + region.parent.ancestors
+        stack.append((region, True))
+        stack.extend((child, False) for child in reversed(region.children))
+
+
+def build_spatial_index():
+    """
+    Index the bounding boxes of all region shapes in an STRtree.
+    Regions are kept in the order of get_all_regions(), so lookups return the same region as a linear scan.
+    """
+    global shaped_regions, shaped_regions_positions, shaped_regions_tree
+    shaped_regions = [region for region in all_regions_dict.values() if region.has_shape()]
+    shaped_regions_positions = {id(region.shape): i for i, region in enumerate(shaped_regions)}
+    shaped_regions_tree = STRtree([region.shape for region in shaped_regions]) if len(shaped_regions) > 0 else None
+
+
+def get_candidate_regions(point):
+    """
+    :return: Regions whose bounding box contains the point, in the order of get_all_regions().
+    """
+    if shaped_regions_tree is None:
+        return []
+    hits = shaped_regions_tree.query(point)
+    if len(hits) > 0 and not isinstance(hits[0], numbers.Integral):
+        # Shapely < 2.0 returns the geometries instead of their indices.
+        hits = [shaped_regions_positions[id(hit)] for hit in hits]
+    return [shaped_regions[i] for i in sorted(hits)]
 
 
 def get_all_regions():
+    ensure_regions_loaded()
     return all_regions_dict.values()
 
 
+def get_preorder_region_ids():
+    """
+    :return: Region ids in preorder, every region comes before its sub-regions.
+    """
+    ensure_regions_loaded()
+    return regions_preorder_ids
+
+
 def is_in_region(region, ancestor):
     if ancestor is None:
         return True
     if region is None:
         return False
-    if region.region_id == ancestor.region_id:
-        return True
-    return is_in_region(region.get_parent(), ancestor)
+    return ancestor.contains_region(region)
 
 
 def get_region_by_id(region_id):
+    ensure_regions_loaded()
     if region_id not in all_regions_dict:
         return None
     return all_regions_dict[region_id]
@@ -127,8 +296,20 @@ def get_global_region():
 
 # Function that returns region name based on input data
 def get_smallest_region_by_coordinates(longitude, latitude):
+    ensure_regions_loaded()
+    point = Point(longitude, latitude)
+    for region in get_candidate_regions(point):
+        if region.contains_point(point):
+            return region
+    return None
+
+
+def get_smallest_region_by_coordinates_scan(longitude, latitude):
+    """
+    Reference implementation without spatial index, used to benchmark and verify the indexed lookup.
+    """
     point = Point(longitude, latitude)
     for region in get_all_regions():
-        if region.has_shape() and region.contains_point(point):
+        if region.has_shape() and region.shape.contains(point):
             return region
     return None
@@ -1,78 +1,434 @@
+import datetime
+import json
 import logging
+import random
+import time
+import urllib.error
+import urllib.request
+from multiprocessing.pool import ThreadPool
 
 import click
+from bson import ObjectId
+from pymongo import DeleteOne, InsertOne, UpdateOne, errors
 
-from helpers.topics import get_static_topics, transform_topic_name
+from helpers.topics import Topic, TopicMatcher, get_static_topics, transform_topic_name
+from helpers.tweet import CLASSIFIER_VERSION, get_attribute_if_exists
 from main import app
-from processing import db, Tweet
+from processing import db, maintenance_db, Tweet, regions, sentiment, summaries, indexes, SHORT_INTERVAL_LENGTH
+from processing import create_mongo_client, get_metadata, set_metadata, update
+from processing.database import MONGO_MAINTENANCE_SOCKET_TIMEOUT_MS
+
+
+RECLASSIFICATION_BATCH_SIZE = 1000
+RECLASSIFICATION_SHARDS = 64
+RECLASSIFICATION_METADATA_KEY = "reclassification"
+RECLASSIFICATION_PROJECTION = {"text": 1, "coordinates": 1}
+
+# Database of a reclassification process, MongoClient instances are not shared with forked processes.
+shard_db = None
 
 
 @app.cli.command()
-def cli_update_sentiment_and_region_classification():
+@click.option('--processes', default=0, help='Number of processes reclassifying shards, 0 to reclassify in-process.')
+def cli_update_sentiment_and_region_classification(processes):
     click.echo("Running update_region_and_topic_classification")
-    update_sentiment_and_region_classification()
+    nb_updated = update_sentiment_and_region_classification(processes)
+    click.echo("Reclassified {} tweets".format(nb_updated))
+    summaries.rebuild_summaries()
+    click.echo("Sentiment cache: {}".format(sentiment.get_cache_stats()))
     click.echo("Done")
 
 
-def update_sentiment_and_region_classification():
-    cursor = db.tweets.find({})
-    for t in cursor:
+def get_stale_classification_filter():
+    return {"classifier_version": {"$ne": CLASSIFIER_VERSION}}
+
+
+def get_shard_ranges(nb_shards):
+    """
+    Split the _id range of the stale tweets in ranges of equal duration, as ObjectIds start with their creation time.
+    :return: List of (first _id, end _id) ranges.
+    """
+    first = maintenance_db.tweets.find_one(get_stale_classification_filter(), {"_id": 1}, sort=[("_id", 1)])
+    if first is None:
+        return []
+    last = maintenance_db.tweets.find_one(get_stale_classification_filter(), {"_id": 1}, sort=[("_id", -1)])
+    start = first["_id"].generation_time
+    end = last["_id"].generation_time + datetime.timedelta(seconds=1)
+    step = (end - start) / nb_shards
+    bounds = []
+    for i in range(nb_shards + 1):
+        bound = ObjectId.from_datetime(start + step * i if i < nb_shards else end)
+        if len(bounds) == 0 or bound != bounds[-1]:
+            bounds.append(bound)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def get_reclassification_job(nb_shards=RECLASSIFICATION_SHARDS):
+    """
+    :return: The unfinished reclassification job for the current classifier version, or a new one.
+    """
+    job = get_metadata(RECLASSIFICATION_METADATA_KEY)
+    if job is None or job["version"] != CLASSIFIER_VERSION or job["complete"]:
+        shards = [list(shard) for shard in get_shard_ranges(nb_shards)]
+        set_metadata(RECLASSIFICATION_METADATA_KEY, version=CLASSIFIER_VERSION, shards=shards, completed=[],
+                     complete=False)
+        job = get_metadata(RECLASSIFICATION_METADATA_KEY)
+    return job
+
+
+def connect_shard_process():
+    global shard_db
+    shard_db = create_mongo_client(socket_timeout_ms=MONGO_MAINTENANCE_SOCKET_TIMEOUT_MS).database
+
+
+def reclassify_batch(tweets, batch):
+    """
+    :return: Number of reclassified tweets.
+    """
+    if len(batch) == 0:
+        return 0
+    # Score the batch up front and hand the scores to the tweets, so every text is looked up in the cache once.
+    batch_scores = sentiment.get_tweets_sentiment(batch)
+    requests = []
+    for t, scores in zip(batch, batch_scores):
         tweet = Tweet.load_stripped_tweet(t)
-        tweet.process()
-        db.tweets.update_one({"_id": tweet.id}, {"$set": tweet.get_full_dict()})
+        try:
+            tweet.process(scores)
+        except Exception as ex:
+            logging.error("Failed to reclassify tweet {}: {}".format(tweet.id, ex))
+            continue
+        requests.append(UpdateOne({"_id": tweet.id}, {"$set": {
+            "sentiment": tweet.sentiment,
+            "region_id": tweet.region_id,
+            "classifier_version": tweet.classifier_version
+        }}))
+    if len(requests) > 0:
+        tweets.bulk_write(requests, ordered=False)
+    return len(requests)
+
+
+def reclassify_shard(indexed_shard):
+    """
+    Reclassify the stale tweets of an _id range in batches.
+    :return: Tuple (shard index, number of reclassified tweets).
+    """
+    index, (start, end) = indexed_shard
+    tweets = (shard_db if shard_db is not None else maintenance_db).tweets
+    query = get_stale_classification_filter()
+    query["_id"] = {"$gte": start, "$lt": end}
+    nb_updated = 0
+    batch = []
+    for t in tweets.find(query, RECLASSIFICATION_PROJECTION, sort=[("_id", 1)], batch_size=RECLASSIFICATION_BATCH_SIZE):
+        batch.append(t)
+        if len(batch) >= RECLASSIFICATION_BATCH_SIZE:
+            nb_updated += reclassify_batch(tweets, batch)
+            batch = []
+    nb_updated += reclassify_batch(tweets, batch)
+    return index, nb_updated
+
+
+def update_sentiment_and_region_classification(processes=0):
+    """
+    Reclassify the tweets whose classifier version is not current. The stale tweets are split in _id ranges that are
+    reclassified in parallel. Completed ranges are checkpointed, so an interrupted job resumes with the others.
+    :return: Number of reclassified tweets.
+    """
+    job = get_reclassification_job()
+    pending = [(i, shard) for i, shard in enumerate(job["shards"]) if i not in job["completed"]]
+    nb_updated = 0
+    if len(pending) > 0:
+        summaries.invalidate_summaries()
+        pool = sentiment.create_pool(processes, initializer=connect_shard_process) if processes > 0 else None
+        try:
+            results = pool.imap_unordered(reclassify_shard, pending) if pool is not None \
+                else map(reclassify_shard, pending)
+            for index, nb_shard_updated in results:
+                db.metadata.update_one({"_id": RECLASSIFICATION_METADATA_KEY}, {"$addToSet": {"completed": index}})
+                nb_updated += nb_shard_updated
+                job["completed"].append(index)
+                logging.info("Reclassified shard {} ({} tweets), {} shards left"
+                             .format(index, nb_shard_updated, len(job["shards"]) - len(job["completed"])))
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+    set_metadata(RECLASSIFICATION_METADATA_KEY, complete=True)
+    return nb_updated
 
 
 @app.cli.command()
-def cli_remove_irrelevant_tweets():
-    click.echo("Running remove_irrelevant_tweets")
-    nb_invalid_classification, nb_no_topics, nb_transformed_topic_names = remove_irrelevant_tweets()
-    click.echo("Removed {} because they were assigned to an invalid topic".format(nb_invalid_classification))
-    click.echo("Removed {} because they had no topic assigned".format(nb_no_topics))
-    click.echo("Removed {} because they had an invalid topic name".format(nb_transformed_topic_names))
+@click.option('--dry-run', is_flag=True, help='Only count the tweets that would be removed or renamed.')
+def cli_remove_irrelevant_tweets(dry_run):
+    click.echo("Running remove_irrelevant_tweets{}".format(" (dry run)" if dry_run else ""))
+    report = remove_irrelevant_tweets(dry_run)
+    click.echo("Scanned {} tweets in {:.1f} seconds ({:.0f} tweets/s)"
+               .format(report.nb_scanned, report.elapsed, report.get_rate()))
+    click.echo("Removed {} because they were assigned to an invalid topic".format(report.nb_invalid_classification))
+    click.echo("Removed {} because they had no topic assigned".format(report.nb_no_topics))
+    click.echo("Removed {} because they had an invalid topic name".format(report.nb_transformed_topic_names))
+    click.echo("Added {} copies under their valid topics, {} were already stored"
+               .format(report.nb_copies - report.nb_duplicates, report.nb_duplicates))
+    if not dry_run:
+        summaries.rebuild_summaries()
     click.echo("Done")
 
 
-def remove_irrelevant_tweets():
-    cursor = db.tweets.find({})
-    static_topics = get_static_topics()
-    static_topics = {topic.topic_name: topic for topic in static_topics}
-    nb_invalid_classification = 0
-    nb_no_topics = 0
-    nb_transformed_topic_names = 0
-    for t in cursor:
-        tweet = Tweet.load_stripped_tweet(t)
-        if tweet.topic in static_topics:
-            if static_topics[tweet.topic].tweet_is_about_topic(tweet.text):
-                continue
-            logging.info("Invalid topic classification ({}) for tweet {}".format(tweet.topic, tweet.text))
-            for topic_name, topic in static_topics.items():
-                if topic.tweet_is_about_topic(tweet.text):
-                    logging.info("Instead classifying as {}".format(topic_name))
-                    current = db.tweets.find_one({"tweet_id": tweet.tweet_id, "topic": topic_name})
-                    if current is not None:
-                        logging.info("Already present")
-                        continue
-                    logging.info("Newly added")
-                    updated_dict = tweet.get_full_dict()
-                    updated_dict["topic"] = topic_name
-                    db.tweets.insert_one(updated_dict)
-            nb_invalid_classification += 1
-            db.tweets.delete_one({"_id": tweet.id})
-        elif tweet.topic is None:
-            nb_no_topics += 1
-            db.tweets.delete_one({"_id": tweet.id})
-        else:
-            transformed_topic = transform_topic_name(tweet.topic)
-            if transformed_topic == tweet.topic:
-                continue
-            db.tweets.delete_one({"_id": tweet.id})
-            nb_transformed_topic_names += 1
-            if db.tweets.find_one({"tweet_id": tweet.tweet_id, "topic": transformed_topic}) is not None:
-                continue
-            updated_dict = tweet.get_full_dict()
-            updated_dict["topic"] = transformed_topic
-            if db.tweets.find_one({"tweet_id": tweet.tweet_id, "topic": transformed_topic}) is not None:
-                continue
-            db.tweets.insert_one(updated_dict)
-
-    return nb_invalid_classification, nb_no_topics, nb_transformed_topic_names
+@app.cli.command('ingest')
+@click.option('--processes', default=None, type=int, help='Number of processes used to parse and classify tweets.')
+@click.option('--no-mining', is_flag=True, help='Only store the spool segments written by another miner.')
+@click.option('--skip-cleanup', is_flag=True,
+              help='Do not run the cleanup scripts after storing the old tweets, also set by SEND_OLD_TWEETS=0.')
+def cli_ingest(processes, no_mining, skip_cleanup):
+    from mining import ingestion
+
+    click.echo("Running the ingestion service")
+    ingestion.run_ingestion(processes if processes is not None else ingestion.INGESTION_PROCESSES,
+                            mine=not no_mining, cleanup=not skip_cleanup and ingestion.is_cleanup_enabled())
+
+
+@app.cli.command()
+@click.argument('paths', nargs=-1)
+@click.option('--processes', default=4, help='Number of processes used to parse and classify tweets.')
+def cli_replay_tweets(paths, processes):
+    from mining import ingestion, replay
+
+    if len(paths) == 0:
+        paths = ingestion.get_sealed_segments()
+    click.echo("Replaying {} spool segments".format(len(paths)))
+    progress = replay.replay_segments(paths, processes=processes)
+    click.echo("Stored {} tweets, {} already stored, {} errors"
+               .format(progress.nb_inserted, progress.nb_duplicates, progress.nb_errors))
+    click.echo("Done")
+
+
+CLEANUP_BATCH_SIZE = 1000
+CLEANUP_PROJECTION = {"_id": 1, "topic": 1, "text": 1}
+CLEANUP_PROGRESS_INTERVAL = 10  # seconds between rate reports
+
+
+class CleanupReport:
+    def __init__(self):
+        self.nb_scanned = 0
+        self.nb_invalid_classification = 0
+        self.nb_no_topics = 0
+        self.nb_transformed_topic_names = 0
+        self.nb_copies = 0
+        self.nb_duplicates = 0
+        self.start_time = time.time()
+        self.elapsed = 0
+
+    def get_rate(self):
+        return self.nb_scanned / self.elapsed if self.elapsed > 0 else 0
+
+    def update_elapsed(self):
+        self.elapsed = time.time() - self.start_time
+
+
+def get_cleanup_changes(t, static_topics, static_matcher, report):
+    """
+    Decide what happens to a projected tweet document, the same way for every tweet of a batch.
+    :return: Tuple (whether to delete the tweet, topics to store a copy of the tweet under).
+    """
+    topic = get_attribute_if_exists(t, "topic")
+    if topic in static_topics:
+        text = get_attribute_if_exists(t, "text") or ""
+        matching_topics = [matching.topic_name for matching in static_matcher.match(text)]
+        if topic in matching_topics:
+            return False, []
+        # Store the tweet under the static topics it is about instead.
+        report.nb_invalid_classification += 1
+        return True, matching_topics
+    if topic is None:
+        report.nb_no_topics += 1
+        return True, []
+    transformed_topic = transform_topic_name(topic)
+    if transformed_topic == topic:
+        return False, []
+    report.nb_transformed_topic_names += 1
+    return True, [transformed_topic]
+
+
+def plan_cleanup_batch(batch, static_topics, static_matcher, report):
+    """
+    :return: Tuple (_ids of the tweets to delete, dictionary from _id to the topics to store a copy of the tweet under).
+    """
+    deleted_ids = []
+    copies = dict()
+    for t in batch:
+        delete, topics = get_cleanup_changes(t, static_topics, static_matcher, report)
+        if delete:
+            deleted_ids.append(t["_id"])
+        if len(topics) > 0:
+            copies[t["_id"]] = topics
+    report.nb_copies += sum(len(topics) for topics in copies.values())
+    return deleted_ids, copies
+
+
+def apply_cleanup_batch(deleted_ids, copies, report):
+    """
+    Insert the copies and delete the irrelevant tweets of a batch with one unordered bulk write.
+    Copies that are already stored violate the unique (tweet_id, topic) index and are skipped.
+    """
+    requests = []
+    if len(copies) > 0:
+        for document in maintenance_db.tweets.find({"_id": {"$in": list(copies.keys())}}):
+            for topic in copies[document["_id"]]:
+                copy = {key: value for key, value in document.items() if key != "_id"}
+                copy["topic"] = topic
+                requests.append(InsertOne(copy))
+    requests.extend(DeleteOne({"_id": tweet_id}) for tweet_id in deleted_ids)
+    try:
+        maintenance_db.tweets.bulk_write(requests, ordered=False)
+    except errors.BulkWriteError as err:
+        write_errors = err.details["writeErrors"]
+        if any(error["code"] != update.DUPLICATE_KEY_ERROR for error in write_errors):
+            raise
+        report.nb_duplicates += len(write_errors)
+
+
+def remove_irrelevant_tweets(dry_run=False):
+    """
+    Remove tweets without a topic, move tweets assigned to a static topic they are not about to the static topics
+    they are about, and rename topics that are not normalized.
+    :param dry_run: Only count the changes.
+    :return: CleanupReport.
+    """
+    static_topics = {topic.topic_name: topic for topic in get_static_topics()}
+    static_matcher = TopicMatcher(static_topics.values())
+    report = CleanupReport()
+    last_report = report.start_time
+    summaries_invalidated = False
+
+    def cleanup_batch(batch):
+        nonlocal summaries_invalidated, last_report
+        deleted_ids, copies = plan_cleanup_batch(batch, static_topics, static_matcher, report)
+        if not dry_run and len(deleted_ids) > 0:
+            if not summaries_invalidated:
+                summaries.invalidate_summaries()
+                summaries_invalidated = True
+            apply_cleanup_batch(deleted_ids, copies, report)
+        if time.time() - last_report >= CLEANUP_PROGRESS_INTERVAL:
+            last_report = time.time()
+            report.update_elapsed()
+            logging.info("Cleanup scanned {} tweets ({:.0f} tweets/s)".format(report.nb_scanned, report.get_rate()))
+
+    batch = []
+    for t in maintenance_db.tweets.find({}, CLEANUP_PROJECTION, batch_size=CLEANUP_BATCH_SIZE):
+        batch.append(t)
+        report.nb_scanned += 1
+        if len(batch) >= CLEANUP_BATCH_SIZE:
+            cleanup_batch(batch)
+            batch = []
+    cleanup_batch(batch)
+    report.update_elapsed()
+    logging.info("Cleanup scanned {} tweets in {:.1f} seconds ({:.0f} tweets/s): {} invalid topics, {} without topic, "
+                 "{} renamed topics{}".format(report.nb_scanned, report.elapsed, report.get_rate(),
+                                              report.nb_invalid_classification, report.nb_no_topics,
+                                              report.nb_transformed_topic_names, " (dry run)" if dry_run else ""))
+    return report
+
+
+@app.cli.command()
+def cli_create_indexes():
+    click.echo("Running create_indexes")
+    indexes.create_indexes()
+    click.echo("Done")
+
+
+@app.cli.command()
+@click.option('--topic', default='sample', help='Topic used in the explained queries.')
+def cli_explain_queries(topic):
+    click.echo("Explaining query shapes")
+    now = datetime.datetime.now()
+    interval = (now - SHORT_INTERVAL_LENGTH, now)
+    results = indexes.explain_query_shapes(interval, topic, regions.get_global_region().region_id)
+    for name, collection_scan in results:
+        click.echo("{}: {}".format(name, "COLLSCAN" if collection_scan else "ok"))
+    nb_collection_scans = sum(1 for name, collection_scan in results if collection_scan)
+    if nb_collection_scans > 0:
+        raise click.ClickException("{} query shapes do a collection scan".format(nb_collection_scans))
+    click.echo("Done")
+
+
+@app.cli.command()
+def cli_rebuild_summaries():
+    click.echo("Running rebuild_summaries")
+    summaries.rebuild_summaries()
+    click.echo("Done")
+
+
+@app.cli.command()
+@click.option('--nb-points', default=10000, help='Number of random points to look up.')
+def cli_benchmark_region_lookup(nb_points):
+    click.echo("Benchmarking region lookup on {} random points".format(nb_points))
+    bounds = [region.shape.bounds for region in regions.get_all_regions() if region.has_shape()]
+    min_x, min_y = min(b[0] for b in bounds), min(b[1] for b in bounds)
+    max_x, max_y = max(b[2] for b in bounds), max(b[3] for b in bounds)
+    points = [(random.uniform(min_x, max_x), random.uniform(min_y, max_y)) for _ in range(nb_points)]
+
+    start_time = time.time()
+    scan_results = [regions.get_smallest_region_by_coordinates_scan(x, y) for x, y in points]
+    scan_time = time.time() - start_time
+
+    start_time = time.time()
+    index_results = [regions.get_smallest_region_by_coordinates(x, y) for x, y in points]
+    index_time = time.time() - start_time
+
+    nb_mismatches = sum(1 for a, b in zip(scan_results, index_results) if a is not b)
+    click.echo("Linear scan: {:.0f} lookups/s".format(nb_points / scan_time))
+    click.echo("Spatial index: {:.0f} lookups/s".format(nb_points / index_time))
+    click.echo("Mismatches: {}".format(nb_mismatches))
+
+
+@app.cli.command()
+@click.option('--repeat', default=1000, help='Number of passes over the sample tweets.')
+def cli_benchmark_topic_matching(repeat):
+    with open('data/tweetlondon.json', 'r') as f:
+        texts = [tweet['text'] for tweet in json.load(f) if 'text' in tweet] * repeat
+    # Hashtags of the sample stand in for the trending topics.
+    hashtags = sorted({token for text in texts for token in text.lower().split() if token.startswith('#')})
+    topics = [Topic(hashtag) for hashtag in hashtags[:10]] + get_static_topics()
+    click.echo("Benchmarking topic matching of {} tweets against {} topics".format(len(texts), len(topics)))
+
+    start_time = time.time()
+    loop_results = [[topic for topic in topics if topic.tweet_is_about_topic(text)] for text in texts]
+    loop_time = time.time() - start_time
+
+    matcher = TopicMatcher(topics)
+    start_time = time.time()
+    matcher_results = [matcher.match(text) for text in texts]
+    matcher_time = time.time() - start_time
+
+    nb_mismatches = sum(1 for a, b in zip(loop_results, matcher_results) if a != b)
+    click.echo("Per-topic loop: {:.0f} tweets/s".format(len(texts) / loop_time))
+    click.echo("Topic matcher: {:.0f} tweets/s".format(len(texts) / matcher_time))
+    click.echo("Mismatches: {}".format(nb_mismatches))
+
+
+@app.cli.command()
+@click.option('--url', default='http://localhost:5000', help='Base URL of the running server.')
+@click.option('--nb-requests', default=1000, help='Number of requests to send.')
+@click.option('--concurrency', default=8, help='Number of concurrent clients.')
+def cli_benchmark_csv_endpoints(url, nb_requests, concurrency):
+    from views import warmup
+
+    paths = [path for path in warmup.get_warmup_urls() if path.endswith('.csv')]
+    if len(paths) == 0:
+        raise click.ClickException("No CSV endpoint to benchmark, the database has no intervals")
+    click.echo("Benchmarking {} requests on {} CSV endpoints of {} with {} clients"
+               .format(nb_requests, len(paths), url, concurrency))
+
+    def fetch(path):
+        try:
+            with urllib.request.urlopen(url + path) as response:
+                response.read()
+                return response.status == 200
+        except urllib.error.URLError:
+            return False
+
+    pool = ThreadPool(concurrency)
+    start_time = time.time()
+    results = pool.map(fetch, [paths[i % len(paths)] for i in range(nb_requests)])
+    elapsed = time.time() - start_time
+    pool.close()
+    click.echo("{:.0f} requests/s, {} errors".format(nb_requests / elapsed, results.count(False)))
@@ -1,13 +1,140 @@
-from nltk.sentiment.vader import SentimentIntensityAnalyzer
+import hashlib
+import threading
+from collections import OrderedDict
+from multiprocessing import Pool
 
-sid = SentimentIntensityAnalyzer()
+from main import app
+from processing import regions
 
+SENTIMENT_CACHE_SIZE = app.config['SENTIMENT_CACHE_SIZE'] if 'SENTIMENT_CACHE_SIZE' in app.config else 100000
 
-def get_tweet_sentiment(tweet):
-    polarity_scores = sid.polarity_scores(tweet['text'])
+
+analyzer = None
+analyzer_lock = threading.Lock()
+
+
+def get_analyzer():
+    """
+    Import NLTK and load the VADER lexicon on first use instead of on import.
+    """
+    global analyzer
+    if analyzer is None:
+        with analyzer_lock:
+            if analyzer is None:
+                from nltk.sentiment.vader import SentimentIntensityAnalyzer
+                analyzer = SentimentIntensityAnalyzer()
+    return analyzer
+
+
+def score_text(text):
+    polarity_scores = get_analyzer().polarity_scores(text)
     return {
         "pos": polarity_scores['pos'],
         "neg": polarity_scores['neg'],
         "neu": polarity_scores['neu'],
         "compound": polarity_scores['compound']
     }
+
+
+def get_text_key(text):
+    return hashlib.sha1(text.encode("utf-8")).digest()
+
+
+class SentimentEngine:
+    """
+    VADER scoring with an LRU cache keyed by a hash of the text, so retweets and tweets stored
+    for several topics are only scored once.
+    """
+
+    def __init__(self, cache_size=SENTIMENT_CACHE_SIZE):
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.nb_hits = 0
+        self.nb_misses = 0
+
+    def lookup(self, key):
+        with self.lock:
+            if key not in self.cache:
+                self.nb_misses += 1
+                return None
+            self.nb_hits += 1
+            self.cache.move_to_end(key)
+            return self.cache[key]
+
+    def store(self, key, scores):
+        with self.lock:
+            self.cache[key] = scores
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+    def get_text_sentiment(self, text):
+        key = get_text_key(text)
+        scores = self.lookup(key)
+        if scores is None:
+            scores = score_text(text)
+            self.store(key, scores)
+        return dict(scores)
+
+    def get_texts_sentiment(self, texts):
+        """
+        Score a batch of texts. Texts missing from the cache are scored once each.
+        Repeated texts of the batch count as cache hits.
+        """
+        keys = [get_text_key(text) for text in texts]
+        results = dict()
+        missing = dict()
+        nb_repeated = 0
+        for key, text in zip(keys, texts):
+            if key in results or key in missing:
+                nb_repeated += 1
+                continue
+            scores = self.lookup(key)
+            if scores is None:
+                missing[key] = text
+            else:
+                results[key] = scores
+        with self.lock:
+            self.nb_hits += nb_repeated
+        for key, text in missing.items():
+            scores = score_text(text)
+            self.store(key, scores)
+            results[key] = scores
+        return [dict(results[key]) for key in keys]
+
+    def get_cache_stats(self):
+        with self.lock:
+            nb_lookups = self.nb_hits + self.nb_misses
+            return {
+                "size": len(self.cache),
+                "max_size": self.cache_size,
+                "hits": self.nb_hits,
+                "misses": self.nb_misses,
+                "hit_rate": float(self.nb_hits) / nb_lookups if nb_lookups > 0 else 0
+            }
+
+
+engine = SentimentEngine()
+
+
+def create_pool(processes=None, initializer=None):
+    """
+    Process pool for bulk reclassification, as VADER is pure Python and bound by the GIL.
+    The analyzer and the regions are loaded before forking, so the processes share them instead of loading their own.
+    """
+    get_analyzer()
+    regions.ensure_regions_loaded()
+    return Pool(processes, initializer=initializer)
+
+
+def get_tweet_sentiment(tweet):
+    return engine.get_text_sentiment(tweet['text'])
+
+
+def get_tweets_sentiment(tweets):
+    return engine.get_texts_sentiment([tweet['text'] for tweet in tweets])
+
+
+def get_cache_stats():
+    return engine.get_cache_stats()
@@ -0,0 +1,124 @@
+"""
+Materialized rollup of tweets per (interval start, topic, region id).
+Ingestion keeps the rollup up to date with $inc upserts, so analytics queries read one document
+per hour, topic and region instead of every tweet.
+Ingestion stores tweets and their increments while holding summaries_lock shared. A rebuild holds it exclusively, as
+replacing the collection with $out would drop the increments written during the aggregation.
+"""
+
+import logging
+
+from pymongo import UpdateOne
+
+from processing import ingestion_db, maintenance_db, get_metadata, set_metadata, bump_data_generation
+from processing import SHORT_INTERVAL_LENGTH
+from processing.locks import SharedLock
+
+BUCKET_LENGTH = int(SHORT_INTERVAL_LENGTH.total_seconds())
+SUMMARY_FIELDS = ["popularity", "sentiment_sum", "nb_positive", "nb_negative", "nb_neutral"]
+METADATA_KEY = "summaries"
+
+summaries_lock = SharedLock("summaries")
+
+# Aggregation expressions matching Tweet.positive_sentiment, negative_sentiment and neutral_sentiment.
+SENTIMENT_ACCUMULATORS = {
+    "popularity": {"$sum": 1},
+    "sentiment_sum": {"$sum": "$sentiment.compound"},
+    "nb_positive": {"$sum": {"$cond": [{"$gt": ["$sentiment.pos", "$sentiment.neg"]}, 1, 0]}},
+    "nb_negative": {"$sum": {"$cond": [{"$gt": ["$sentiment.neg", "$sentiment.pos"]}, 1, 0]}},
+    "nb_neutral": {"$sum": {"$cond": [{"$eq": ["$sentiment.pos", "$sentiment.neg"]}, 1, 0]}},
+}
+
+
+def get_bucket_start(timestamp):
+    return timestamp - timestamp % BUCKET_LENGTH
+
+
+def get_tweet_increments(tweet):
+    return {
+        "popularity": 1,
+        "sentiment_sum": tweet.get_compound_sentiment(),
+        "nb_positive": int(tweet.positive_sentiment()),
+        "nb_negative": int(tweet.negative_sentiment()),
+        "nb_neutral": int(tweet.neutral_sentiment()),
+    }
+
+
+def update_summaries(tweets):
+    """
+    Add newly stored tweets to the rollup, with one upsert per (bucket, topic, region id).
+    """
+    increments = dict()
+    for tweet in tweets:
+        key = (get_bucket_start(tweet.timestamp), tweet.topic, tweet.region_id)
+        totals = increments.setdefault(key, dict.fromkeys(SUMMARY_FIELDS, 0))
+        for field, value in get_tweet_increments(tweet).items():
+            totals[field] += value
+    if len(increments) == 0:
+        return
+    ingestion_db.summaries.bulk_write([
+        UpdateOne({"interval_start": key[0], "topic": key[1], "region_id": key[2]}, {"$inc": totals}, upsert=True)
+        for key, totals in increments.items()
+    ], ordered=False)
+
+
+def invalidate_summaries():
+    """
+    Stop serving reads from the rollup, e.g. while tweets are being reclassified or removed.
+    """
+    set_metadata(METADATA_KEY, complete=False)
+    bump_data_generation()
+
+
+def rebuild_summaries():
+    """
+    Recompute the whole rollup from the tweets collection. Ingestion is paused until the rebuild is done.
+    """
+    logging.info("Rebuilding tweet summaries")
+    with summaries_lock.exclusive():
+        rebuild_summaries_collection()
+    logging.info("Done rebuilding tweet summaries")
+
+
+def rebuild_summaries_collection():
+    invalidate_summaries()
+    group = {"_id": {
+        "interval_start": {"$subtract": ["$timestamp", {"$mod": ["$timestamp", BUCKET_LENGTH]}]},
+        "topic": "$topic",
+        "region_id": "$region_id",
+    }}
+    group.update(SENTIMENT_ACCUMULATORS)
+    project = {"_id": 0, "interval_start": "$_id.interval_start", "topic": "$_id.topic", "region_id": "$_id.region_id"}
+    project.update({field: 1 for field in SUMMARY_FIELDS})
+    maintenance_db.tweets.aggregate([{"$group": group}, {"$project": project}, {"$out": "summaries"}],
+                                    allowDiskUse=True)
+    set_metadata(METADATA_KEY, complete=True)
+    bump_data_generation()
+
+
+def is_complete():
+    metadata = get_metadata(METADATA_KEY)
+    return metadata is not None and metadata.get("complete", False)
+
+
+def is_aligned(interval):
+    """
+    :return: Whether the interval boundaries fall on bucket boundaries.
+    """
+    start, end = interval[0].timestamp(), interval[1].timestamp()
+    return start % BUCKET_LENGTH == 0 and end % BUCKET_LENGTH == 0
+
+
+def covers_interval(interval):
+    """
+    :return: Whether the rollup is complete and the interval boundaries fall on bucket boundaries.
+    """
+    return is_aligned(interval) and is_complete()
+
+
+def covers_intervals(intervals):
+    """
+    Read the rollup metadata once for all the intervals.
+    :return: Whether the rollup is complete and all the interval boundaries fall on bucket boundaries.
+    """
+    return len(intervals) > 0 and all(is_aligned(interval) for interval in intervals) and is_complete()
@@ -1,28 +1,88 @@
 """
-Store tweets more recent than SHORT_TERM in .json file
-Older tweets that are passed to process_new_tweets are discarded.
-Newer tweets are taken into account.
+Classify and store mined tweets, see mining.replay for the replay of the spool segments.
 """
 
+import logging
+
+from pymongo import errors
+
 from helpers.tweet import Tweet
-from processing import db
+from processing import ingestion_db, sentiment, summaries, get_ingestion_state, seed_earliest_time
+from processing import INGESTION_METADATA_KEY
 
+DUPLICATE_KEY_ERROR = 11000
 
-def get_tweet_by_twitter_id(tweet_id):
-    return db.tweets.find_one({"tweet_id": tweet_id})
 
+def insert_tweets(tweets):
+    """
+    Insert tweets with a single unordered bulk insert.
+    Tweets that violate the unique (tweet_id, topic) index are already stored and are skipped.
+    :return: Tuple (inserted tweets, number of duplicates).
+    """
+    if len(tweets) == 0:
+        return [], 0
+    try:
+        ingestion_db.tweets.insert_many([tweet.get_full_dict() for tweet in tweets], ordered=False)
+        return tweets, 0
+    except errors.BulkWriteError as err:
+        write_errors = err.details["writeErrors"]
+        other_errors = [error for error in write_errors if error["code"] != DUPLICATE_KEY_ERROR]
+        if len(other_errors) > 0:
+            raise
+        duplicate_indices = {error["index"] for error in write_errors}
+        return [tweet for i, tweet in enumerate(tweets) if i not in duplicate_indices], len(write_errors)
 
-def insert_tweet(tweet):
-    db.tweets.insert_one(tweet.get_full_dict())
 
+def record_ingestion(tweets):
+    """
+    Move the ingestion watermark to the newest stored tweet. Tweets older than the current watermark
+    change intervals that readers may consider closed, so they bump the data generation.
+    """
+    if len(tweets) == 0:
+        return
+    state = get_ingestion_state()
+    if state["earliest"] is None:
+        # On a database filled before the metadata kept the earliest timestamp, the first $min would otherwise hide
+        # all older tweets from the intervals.
+        seed_earliest_time()
+    update = {
+        "$max": {"watermark": max(tweet.timestamp for tweet in tweets)},
+        "$min": {"earliest": min(tweet.timestamp for tweet in tweets)}
+    }
+    if min(tweet.timestamp for tweet in tweets) < state["watermark"]:
+        update["$inc"] = {"generation": 1}
+    ingestion_db.metadata.update_one({"_id": INGESTION_METADATA_KEY}, update, upsert=True)
 
-def store_new_tweets(new_tweets_original):
+
+def classify_tweets(new_tweets_original):
+    """
+    Parse raw mined tweets and run sentiment and region classification on them.
+    Tweets that cannot be parsed are logged and dropped.
+    """
+    # Score the batch up front and hand the scores to the tweets, so every text is looked up in the cache once.
+    scored_objs = [tweet_obj for tweet_obj in new_tweets_original if "text" in tweet_obj]
+    batch_scores = {id(tweet_obj): scores
+                    for tweet_obj, scores in zip(scored_objs, sentiment.get_tweets_sentiment(scored_objs))}
+    tweets = []
     for tweet_obj in new_tweets_original:
-        tweet = Tweet.load_raw_tweet(tweet_obj)
-        if get_tweet_by_twitter_id(tweet.tweet_id) is not None:
-            continue
-        insert_tweet(tweet)
+        try:
+            for tweet in Tweet.load_raw_tweets(tweet_obj, batch_scores.get(id(tweet_obj))):
+                tweet.classify()
+                tweets.append(tweet)
+        except Exception as ex:
+            logging.error("Failed to classify tweet: {}".format(ex))
+    return tweets
+
 
+def store_tweets(tweets):
+    """
+    Insert classified tweets and account for the new ones in the summaries and the ingestion state.
+    :return: Tuple (number of inserted tweets, number of tweets that were already stored).
+    """
+    # Waits while the summaries are rebuilt, see summaries.summaries_lock.
+    with summaries.summaries_lock.shared():
+        inserted_tweets, nb_duplicates = insert_tweets(tweets)
+        summaries.update_summaries(inserted_tweets)
+    record_ingestion(inserted_tweets)
+    return len(inserted_tweets), nb_duplicates
 
-def process_new_tweets(new_tweets_original):
-    store_new_tweets(new_tweets_original)
@@ -0,0 +1,2 @@
+# The processing package and the views import each other through main, so load the app first, as flask and wsgi.py do.
+import main  # noqa: F401
@@ -0,0 +1,121 @@
+import pytest
+from flask import Response
+
+from main import app
+from views import cache
+
+
+def make_entry(body, immutable=True):
+    return cache.CachedResponse(body, 200, [("Content-Type", "text/csv")], immutable)
+
+
+@pytest.fixture
+def response_cache(monkeypatch):
+    response_cache = cache.ResponseCache(100)
+    monkeypatch.setattr(cache, "response_cache", response_cache)
+    return response_cache
+
+
+@pytest.fixture
+def ingestion_state(monkeypatch):
+    state = {"watermark": 1000, "generation": 0, "earliest": 0, "ingested_at": None}
+    monkeypatch.setattr(cache, "get_current_ingestion_state", lambda: state)
+    return state
+
+
+def test_evicts_least_recently_used(response_cache):
+    response_cache.put("a", make_entry(b"a" * 40))
+    response_cache.put("b", make_entry(b"b" * 40))
+    assert response_cache.get("a") is not None
+    response_cache.put("c", make_entry(b"c" * 40))
+    assert response_cache.get("b") is None
+    assert response_cache.get("a") is not None
+    assert response_cache.get("c") is not None
+    stats = response_cache.get_stats()
+    assert stats["evictions"] == 1
+    assert stats["size"] == 80
+    assert stats["entries"] == 2
+
+
+def test_replacing_an_entry_keeps_the_size(response_cache):
+    response_cache.put("a", make_entry(b"a" * 40))
+    response_cache.put("a", make_entry(b"a" * 60))
+    assert response_cache.get_stats()["size"] == 60
+    assert response_cache.get("a").body == b"a" * 60
+
+
+def test_entries_larger_than_the_cache_are_not_stored(response_cache):
+    response_cache.put("a", make_entry(b"a" * 101))
+    assert response_cache.get("a") is None
+    assert response_cache.get_stats()["uncacheable"] == 1
+
+
+def test_open_responses_expire(response_cache, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(cache.time, "time", lambda: now[0])
+    response_cache.put("open", make_entry(b"open", immutable=False))
+    response_cache.put("closed", make_entry(b"closed", immutable=True))
+    now[0] += cache.OPEN_RESPONSE_TTL + 1
+    assert response_cache.get("open") is None
+    assert response_cache.get("closed") is not None
+    assert response_cache.get_stats()["expired"] == 1
+
+
+def test_etag_makes_responses_conditional():
+    entry = make_entry(b"body")
+    with app.test_request_context("/", headers={"If-None-Match": '"{}"'.format(entry.etag)}):
+        assert entry.make_response().status_code == 304
+    with app.test_request_context("/", headers={"If-None-Match": '"other"'}):
+        response = entry.make_response()
+        assert response.status_code == 200
+        assert response.get_data() == b"body"
+
+
+def test_get_interval_end():
+    assert cache.get_interval_end("100-200") == 200
+    assert cache.get_interval_end(None) is None
+    assert cache.get_interval_end("100") is None
+    assert cache.get_interval_end("a-b") is None
+
+
+def make_cached_view(calls):
+    @cache.cached_response
+    def view(interval):
+        calls.append(interval)
+        return Response("data for {}".format(interval), mimetype="text/csv")
+
+    return view
+
+
+def test_closed_intervals_are_immutable(response_cache, ingestion_state):
+    calls = []
+    view = make_cached_view(calls)
+    with app.test_request_context("/bubble_chart/0-1000/data.csv"):
+        assert view(interval="0-1000").get_data() == b"data for 0-1000"
+        assert view(interval="0-1000").get_data() == b"data for 0-1000"
+    with app.test_request_context("/bubble_chart/500-1500/data.csv"):
+        view(interval="500-1500")
+    assert calls == ["0-1000", "500-1500"]
+    immutable = {key[0]: entry.immutable for key, entry in response_cache.entries.items()}
+    assert immutable == {"/bubble_chart/0-1000/data.csv?": True, "/bubble_chart/500-1500/data.csv?": False}
+
+
+def test_generation_bump_invalidates(response_cache, ingestion_state):
+    calls = []
+    view = make_cached_view(calls)
+    with app.test_request_context("/bubble_chart/0-1000/data.csv"):
+        view(interval="0-1000")
+        ingestion_state["generation"] += 1
+        view(interval="0-1000")
+    assert calls == ["0-1000", "0-1000"]
+
+
+def test_error_responses_are_not_cached(response_cache, ingestion_state):
+    @cache.cached_response
+    def view(interval):
+        return Response("missing", status=404)
+
+    with app.test_request_context("/bubble_chart/0-1000/data.csv"):
+        assert view(interval="0-1000").status_code == 404
+    assert len(response_cache.entries) == 0
+    assert response_cache.get_stats()["uncacheable"] == 1
@@ -0,0 +1,63 @@
+import datetime
+
+import numpy as np
+import pytest
+
+from processing import data, summaries
+
+
+class EmptyTweetsCollection:
+    def find(self, query, projection=None):
+        return []
+
+
+class EmptyDatabase:
+    tweets = EmptyTweetsCollection()
+
+
+@pytest.fixture
+def old_bincount(monkeypatch):
+    """
+    Reject minlength=0 like numpy 1.12 does.
+    """
+    bincount = np.bincount
+
+    def checked_bincount(x, weights=None, minlength=0):
+        if minlength <= 0:
+            raise ValueError("minlength must be positive")
+        return bincount(x, weights=weights, minlength=minlength)
+
+    monkeypatch.setattr(data.np, "bincount", checked_bincount)
+
+
+def make_columns(rows):
+    columns = data.TweetColumns()
+    for topic, region_id, positive, negative, compound in rows:
+        columns.append({"topic": topic, "region_id": region_id,
+                        "sentiment": {"pos": positive, "neg": negative, "compound": compound}})
+    return columns
+
+
+def test_grouped_summaries_of_no_tweets(old_bincount):
+    assert data.get_grouped_tweets_summaries(data.TweetColumns(), "topics") == {}
+
+
+def test_empty_interval_without_rollup(old_bincount, monkeypatch):
+    monkeypatch.setattr(data, "analytics_db", EmptyDatabase())
+    monkeypatch.setattr(summaries, "is_complete", lambda: False)
+    interval = (datetime.datetime.fromtimestamp(3600 * 1000), datetime.datetime.fromtimestamp(3600 * 1001))
+    assert data.get_interval_topics_details(interval) == {}
+
+
+def test_grouped_summaries_match_per_key_summaries(old_bincount):
+    columns = make_columns([("a", "2_1", 0.5, 0.1, 0.4), ("b", "2_1", 0.1, 0.5, -0.4), ("a", None, 0.2, 0.2, 0),
+                            ("a", "2_2", 0.1, 0.3, -0.2), ("c", "2_2", 0.0, 0.0, 0)])
+    grouped = data.get_grouped_tweets_summaries(columns, "topics")
+    assert sorted(grouped) == ["a", "b", "c"]
+    for topic, summary in grouped.items():
+        rows = [i for i, row_topic in enumerate(columns.topics) if row_topic == topic]
+        positive, negative, compound = (array[rows] for array in columns.get_sentiment_arrays())
+        expected = data.get_arrays_summary(positive, negative, compound)
+        assert (summary.popularity, summary.nb_positive, summary.nb_negative, summary.nb_neutral) == \
+            (expected.popularity, expected.nb_positive, expected.nb_negative, expected.nb_neutral)
+        assert summary.average_sentiment == pytest.approx(expected.average_sentiment)
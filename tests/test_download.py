@@ -0,0 +1,98 @@
+import datetime
+
+import pytest
+
+from processing import data
+
+
+class FakeTweetsCollection:
+    """
+    Answers the interval and topic queries of iter_tweet_documents from a list of documents.
+    """
+
+    def __init__(self, documents):
+        self.documents = documents
+
+    def find(self, query, projection, sort, batch_size):
+        def matches(document):
+            timestamp = query["timestamp"]
+            if not timestamp["$gte"] <= document["timestamp"] < timestamp["$lt"]:
+                return False
+            return "topic" not in query or document["topic"] == query["topic"]
+
+        documents = [document for document in self.documents if matches(document)]
+        return sorted(documents, key=lambda document: tuple(document[field] for field, _ in sort))
+
+
+class FakeDatabase:
+    def __init__(self, documents):
+        self.tweets = FakeTweetsCollection(documents)
+
+
+INTERVAL = (datetime.datetime.fromtimestamp(1000), datetime.datetime.fromtimestamp(2000))
+
+
+@pytest.fixture
+def documents(monkeypatch):
+    # Several tweets and topics share timestamps, so resuming has to skip within a timestamp.
+    documents = [{"timestamp": 1000 + i // 4, "tweet_id": 10 - i % 3, "topic": "topic{}".format(i % 2),
+                  "text": "text {}".format(i), "sentiment": None, "region_id": None} for i in range(40)]
+    documents.append({"timestamp": 2000, "tweet_id": 1, "topic": "topic0", "text": "after the interval",
+                      "sentiment": None, "region_id": None})
+    unique_documents = {(document["timestamp"], document["tweet_id"], document["topic"]): document
+                        for document in documents}
+    documents = list(unique_documents.values())
+    monkeypatch.setattr(data, "analytics_db", FakeDatabase(documents))
+    return documents
+
+
+def get_key(document):
+    return document["timestamp"], document["tweet_id"], document["topic"]
+
+
+def download_in_pages(page_size, topic=None):
+    pages = []
+    cursor = None
+    while True:
+        page = list(data.iter_tweet_documents(INTERVAL, topic=topic, cursor=cursor, limit=page_size))
+        if len(page) == 0:
+            return pages
+        pages.append(page)
+        cursor = data.get_download_cursor(page[-1])
+
+
+def test_cursor_round_trip():
+    document = {"timestamp": 1490000000, "tweet_id": 834402094165663744, "topic": "a:b"}
+    assert data.parse_download_cursor(data.get_download_cursor(document)) == (1490000000, 834402094165663744, "a:b")
+
+
+def test_cursor_must_have_three_parts():
+    with pytest.raises(ValueError):
+        data.parse_download_cursor("1490000000:1")
+    with pytest.raises(ValueError):
+        data.parse_download_cursor("a:1:topic")
+
+
+def test_full_download_is_ordered_and_in_interval(documents):
+    downloaded = list(data.iter_tweet_documents(INTERVAL))
+    keys = [get_key(document) for document in downloaded]
+    assert keys == sorted(get_key(document) for document in documents if document["timestamp"] < 2000)
+    assert set(downloaded[0]) == set(data.TWEET_DOCUMENT_FIELDS)
+
+
+@pytest.mark.parametrize("page_size", [1, 3, 7, 100])
+def test_pages_resume_without_gaps_or_duplicates(documents, page_size):
+    full = list(data.iter_tweet_documents(INTERVAL))
+    pages = download_in_pages(page_size)
+    assert all(len(page) <= page_size for page in pages)
+    assert [document for page in pages for document in page] == full
+
+
+def test_pages_for_a_topic(documents):
+    full = list(data.iter_tweet_documents(INTERVAL, topic="topic1"))
+    assert all(document["topic"] == "topic1" for document in full)
+    assert [document for page in download_in_pages(2, topic="topic1") for document in page] == full
+
+
+def test_zero_limit(documents):
+    assert list(data.iter_tweet_documents(INTERVAL, limit=0)) == []
@@ -0,0 +1,38 @@
+import pytest
+from pymongo import errors
+
+from processing import indexes
+
+
+class RacingCollection:
+    """
+    Lists the replaced indexes, but another process drops them before this one does.
+    """
+
+    def __init__(self, drop_error_code):
+        self.drop_error_code = drop_error_code
+        self.dropped = []
+
+    def index_information(self):
+        return {name: {} for name in ["_id_"] + indexes.REPLACED_INDEXES["tweets"]}
+
+    def drop_index(self, index_name):
+        self.dropped.append(index_name)
+        raise errors.OperationFailure("index not found", code=self.drop_error_code)
+
+
+def install_collection(monkeypatch, collection):
+    monkeypatch.setattr(indexes, "maintenance_db", {"tweets": collection})
+
+
+def test_index_dropped_by_another_process(monkeypatch):
+    collection = RacingCollection(indexes.INDEX_NOT_FOUND_ERROR)
+    install_collection(monkeypatch, collection)
+    indexes.drop_replaced_indexes()
+    assert collection.dropped == indexes.REPLACED_INDEXES["tweets"]
+
+
+def test_other_drop_failures_are_raised(monkeypatch):
+    install_collection(monkeypatch, RacingCollection(13))
+    with pytest.raises(errors.OperationFailure):
+        indexes.drop_replaced_indexes()
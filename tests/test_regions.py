@@ -0,0 +1,144 @@
+import random
+
+import pytest
+from shapely.geometry import box
+
+from processing import regions
+
+
+def install_regions(monkeypatch, region_list):
+    """
+    Replace the loaded regions by region_list and rebuild the hierarchy tables and the spatial index.
+    """
+    for name in ["all_regions_dict", "regions_preorder_ids", "shaped_regions", "shaped_regions_positions",
+                 "shaped_regions_tree", "regions_loaded"]:
+        monkeypatch.setattr(regions, name, getattr(regions, name))
+    regions.all_regions_dict = {region.region_id: region for region in region_list}
+    regions.build_region_hierarchy()
+    regions.build_spatial_index()
+    regions.regions_loaded = True
+
+
+def make_region(name, region_id, parent_id, region_shape=None):
+    region = regions.Region(name, region_id, parent_id)
+    if region_shape is not None:
+        region.set_shape(region_shape)
+    return region
+
+
+@pytest.fixture
+def grid_regions(monkeypatch):
+    """
+    A country with two counties of 4 x 4 unit squares each, and one larger square overlapping both counties.
+    """
+    region_list = [make_region("Country", "0_1", None)]
+    for county in range(2):
+        county_id = "1_{}".format(county)
+        region_list.append(make_region("County {}".format(county), county_id, "0_1"))
+        for x in range(4):
+            for y in range(4):
+                region_list.append(make_region("Square", "2_{}_{}_{}".format(county, x, y), county_id,
+                                               box(county * 4 + x, y, county * 4 + x + 1, y + 1)))
+    region_list.append(make_region("Overlap", "2_overlap", "1_0", box(3.5, 1.5, 4.5, 2.5)))
+    install_regions(monkeypatch, region_list)
+    return region_list
+
+
+def test_indexed_lookup_matches_scan(grid_regions):
+    rng = random.Random(42)
+    points = [(rng.uniform(-1, 9), rng.uniform(-1, 5)) for _ in range(2000)]
+    for longitude, latitude in points:
+        assert regions.get_smallest_region_by_coordinates(longitude, latitude) is \
+            regions.get_smallest_region_by_coordinates_scan(longitude, latitude)
+
+
+def test_lookup_outside_all_regions(grid_regions):
+    assert regions.get_smallest_region_by_coordinates(-5, -5) is None
+    assert regions.get_smallest_region_by_coordinates_scan(-5, -5) is None
+
+
+def test_lookup_finds_leaf(grid_regions):
+    region = regions.get_smallest_region_by_coordinates(5.5, 0.5)
+    assert region.region_id == "2_1_1_0"
+
+
+def test_candidates_keep_region_order(grid_regions):
+    point = regions.Point(3.75, 2)
+    candidates = regions.get_candidate_regions(point)
+    order = [region.region_id for region in regions.get_all_regions() if region.has_shape()]
+    assert [region.region_id for region in candidates] == \
+        sorted((region.region_id for region in candidates), key=order.index)
+    assert "2_overlap" in [region.region_id for region in candidates]
+
+
+def test_no_shapes(monkeypatch):
+    install_regions(monkeypatch, [make_region("Country", "0_1", None)])
+    assert regions.get_candidate_regions(regions.Point(0, 0)) == []
+    assert regions.get_smallest_region_by_coordinates(0, 0) is None
+
+
+def get_descendant_ids(region):
+    """
+    Reference implementation walking the children, to check the preorder ranges against.
+    """
+    ids = [region.region_id]
+    for child in region.children:
+        ids.extend(get_descendant_ids(child))
+    return ids
+
+
+def test_sub_region_ranges_match_tree_walk(grid_regions):
+    for region in regions.get_all_regions():
+        assert sorted(region.get_all_sub_region_ids()) == sorted(get_descendant_ids(region))
+
+
+def test_preorder_puts_parents_first(grid_regions):
+    preorder_ids = regions.get_preorder_region_ids()
+    assert sorted(preorder_ids) == sorted(region.region_id for region in grid_regions)
+    positions = {region_id: i for i, region_id in enumerate(preorder_ids)}
+    for region in regions.get_all_regions():
+        if region.get_parent() is not None:
+            assert positions[region.get_parent().region_id] < positions[region.region_id]
+
+
+def test_is_in_region_matches_ancestors(grid_regions):
+    all_regions = list(regions.get_all_regions())
+    for region in all_regions:
+        for ancestor in all_regions:
+            expected = ancestor is region or ancestor in region.get_ancestors()
+            assert regions.is_in_region(region, ancestor) == expected
+    assert regions.is_in_region(all_regions[0], None)
+    assert not regions.is_in_region(None, all_regions[0])
+
+
+def test_hierarchy_tables(grid_regions):
+    country = regions.get_region_by_id("0_1")
+    county = regions.get_region_by_id("1_0")
+    square = regions.get_region_by_id("2_0_1_1")
+    assert country.get_parent() is None
+    assert square.get_ancestors() == [county, country]
+    assert square.is_leaf() and not county.is_leaf()
+    assert county.get_number_of_leaf_descendants() == 17
+    assert country.get_number_of_leaf_descendants() == 33
+    assert set(child.region_id for child in country.get_children()) == {"1_0", "1_1"}
+
+
+def test_regions_cache_round_trip(grid_regions, monkeypatch, tmp_path):
+    monkeypatch.setattr(regions, "REGIONS_CACHE_FILE", str(tmp_path / "regions.cache"))
+    regions.save_regions_cache("hash")
+    saved = [(region.name, region.region_id, region.parent_id, region.shape.wkb if region.has_shape() else None)
+             for region in regions.get_all_regions()]
+    regions.all_regions_dict = {}
+    assert not regions.load_regions_cache("other hash")
+    assert regions.load_regions_cache("hash")
+    assert [(region.name, region.region_id, region.parent_id, region.shape.wkb if region.has_shape() else None)
+            for region in regions.get_all_regions()] == saved
+
+
+def test_unreadable_regions_cache_is_ignored(grid_regions, monkeypatch, tmp_path):
+    cache_file = tmp_path / "regions.cache"
+    monkeypatch.setattr(regions, "REGIONS_CACHE_FILE", str(cache_file))
+    regions.save_regions_cache("hash")
+    cache_file.write_bytes(cache_file.read_bytes()[:-10])
+    assert not regions.load_regions_cache("hash")
+    assert len(regions.all_regions_dict) == len(grid_regions)
@@ -0,0 +1,43 @@
+import pytest
+
+from mining import replay
+
+
+class FakeManifest:
+    def __init__(self, entries):
+        self.entries = entries
+        self.nb_queries = 0
+
+    def find(self, query, projection):
+        self.nb_queries += 1
+        return [dict(self.entries[key], _id=key) for key in query["_id"]["$in"] if key in self.entries]
+
+
+class FakeDatabase:
+    def __init__(self, entries):
+        self.replay_manifest = FakeManifest(entries)
+
+
+@pytest.fixture
+def manifest(monkeypatch):
+    database = FakeDatabase({
+        "tweets_1": {"offset": 100, "complete": True},
+        "tweets_2": {"offset": 40, "complete": False},
+    })
+    monkeypatch.setattr(replay, "db", database)
+    monkeypatch.setattr(replay, "replaying_segments", set())
+    return database.replay_manifest
+
+
+def test_claim_reads_the_manifest_once(manifest):
+    paths = ["spool/tweets_1", "spool/tweets_2", "spool/tweets_3"]
+    assert replay.claim_pending_segments(paths) == [("spool/tweets_2", 40), ("spool/tweets_3", 0)]
+    assert manifest.nb_queries == 1
+
+
+def test_claimed_segments_are_skipped_until_released(manifest):
+    paths = ["spool/tweets_2", "spool/tweets_3"]
+    segments = replay.claim_pending_segments(paths)
+    assert replay.claim_pending_segments(paths) == []
+    replay.release_segments(segments)
+    assert replay.claim_pending_segments(paths) == segments
@@ -0,0 +1,46 @@
+import glob
+import json
+import os
+
+import pytest
+
+from mining import spool
+
+MAX_SIZE = 64 * 1024
+
+
+def make_batch():
+    # Repetitive text, which compresses well.
+    return [json.dumps({"id": i, "text": "the same tweet text " * 20}) + "\n" for i in range(50)]
+
+
+def write_segments(prefix, compress, nb_batches=20):
+    writer = spool.SpoolWriter(prefix, max_size=MAX_SIZE, max_age=3600, compress=compress)
+    for _ in range(nb_batches):
+        writer.write(make_batch())
+    writer.seal()
+    # Sealed segments are named after the time they were sealed.
+    return sorted(glob.glob(prefix + "_*"), key=lambda path: float(path[len(prefix) + 1:].replace(".gz", "")))
+
+
+def count_lines(paths):
+    nb_lines = 0
+    for path in paths:
+        with spool.open_segment(path) as f:
+            nb_lines += sum(1 for _ in f)
+    return nb_lines
+
+
+@pytest.mark.parametrize("compress", [False, True])
+def test_segments_roll_over_at_size_on_disk(tmp_path, compress):
+    segments = write_segments(str(tmp_path / "tweets"), compress)
+    batch_size = len("".join(make_batch()))
+    assert batch_size * 20 > MAX_SIZE
+    if compress:
+        # The text is larger than the limit, but the compressed segment is not.
+        assert len(segments) == 1
+    else:
+        assert len(segments) > 1
+        for path in segments[:-1]:
+            assert MAX_SIZE <= os.path.getsize(path) < MAX_SIZE + batch_size
+    assert count_lines(segments) == 20 * 50
@@ -0,0 +1,40 @@
+import datetime
+
+import pytest
+
+from processing import summaries
+
+
+@pytest.fixture
+def metadata_reads(monkeypatch):
+    reads = []
+
+    def get_metadata(key):
+        reads.append(key)
+        return {"_id": key, "complete": True}
+
+    monkeypatch.setattr(summaries, "get_metadata", get_metadata)
+    return reads
+
+
+def make_intervals(start, nb_intervals):
+    length = summaries.BUCKET_LENGTH
+    return [(datetime.datetime.fromtimestamp(start + i * length),
+             datetime.datetime.fromtimestamp(start + (i + 1) * length)) for i in range(nb_intervals)]
+
+
+def test_covers_intervals_reads_metadata_once(metadata_reads):
+    assert summaries.covers_intervals(make_intervals(summaries.BUCKET_LENGTH * 1000, 50))
+    assert metadata_reads == [summaries.METADATA_KEY]
+
+
+def test_unaligned_intervals_are_not_covered(metadata_reads):
+    assert not summaries.covers_intervals(make_intervals(summaries.BUCKET_LENGTH * 1000 + 1, 50))
+    assert not summaries.covers_intervals([])
+    assert metadata_reads == []
+
+
+def test_incomplete_rollup_does_not_cover(monkeypatch):
+    monkeypatch.setattr(summaries, "get_metadata", lambda key: {"_id": key, "complete": False})
+    assert not summaries.covers_intervals(make_intervals(summaries.BUCKET_LENGTH * 1000, 3))
+    assert not summaries.covers_interval(make_intervals(summaries.BUCKET_LENGTH * 1000, 1)[0])
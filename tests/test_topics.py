@@ -0,0 +1,54 @@
+import json
+
+from helpers.topics import Topic, TopicMatcher, get_static_topics, transform_topic_name
+
+
+def match_per_topic(topics, text):
+    return [topic for topic in topics if topic.tweet_is_about_topic(text)]
+
+
+def get_sample_texts():
+    with open('data/tweetlondon.json', 'r') as f:
+        return [tweet['text'] for tweet in json.load(f) if 'text' in tweet]
+
+
+def test_matcher_matches_per_topic_loop_on_sample():
+    texts = get_sample_texts()
+    hashtags = sorted({token for text in texts for token in text.lower().split() if token.startswith('#')})
+    topics = [Topic(hashtag) for hashtag in hashtags[:10]] + get_static_topics()
+    matcher = TopicMatcher(topics)
+    for text in texts:
+        assert matcher.match(text) == match_per_topic(topics, text)
+
+
+def test_matcher_edge_cases():
+    topics = [
+        Topic("#London"),
+        Topic("brexit", ["brexit", "#brexit", "eu"]),
+        Topic("duplicate tags", ["eu", "eu"]),
+        Topic("Mixed case tag", ["Tube"]),
+        Topic("multi word", ["new york"]),
+    ]
+    matcher = TopicMatcher(topics)
+    texts = [
+        "",
+        "#london calling",
+        "#LONDON and the EU after #Brexit",
+        "eu eu eu",
+        "tube strike in new york",
+        "Tube",
+        "london",
+    ]
+    for text in texts:
+        assert matcher.match(text) == match_per_topic(topics, text)
+
+
+def test_matcher_keeps_topic_order():
+    topics = [Topic("b", ["x"]), Topic("a", ["y"]), Topic("c", ["x"])]
+    assert [topic.topic_name for topic in TopicMatcher(topics).match("y x")] == ["b", "a", "c"]
+
+
+def test_transform_topic_name():
+    assert transform_topic_name("#Brexit") == "brexit"
+    assert transform_topic_name("New York") == "newyork"
+    assert transform_topic_name("") == ""
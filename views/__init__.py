@@ -1,5 +1,12 @@
+import logging
+
+from pymongo import errors
+
 from main import app
+from processing import sentiment, database
 from processing.data import count_tweets
+from helpers.tweet import get_classification_counts
+from views import cache, warmup
 from views.authentication import *
 from views.data import *
 from views.sitemap import *
@@ -19,5 +26,23 @@ def application():
 @app.route('/stats')
 def stats():
     return jsonify({
-        "nb_tweets": count_tweets({})
+        "nb_tweets": count_tweets({}),
+        "sentiment_cache": sentiment.get_cache_stats(),
+        "classifications": get_classification_counts(),
+        "response_cache": cache.get_cache_stats(),
+        "ingestion": cache.get_current_ingestion_state(),
+        "mongo_pool": database.get_pool_stats()
     })
+
+
+@app.errorhandler(errors.ConnectionFailure)
+def database_unavailable(error):
+    """
+    Server selection, pool wait queue and socket timeouts: answer 503 so that clients retry later.
+    """
+    database.pool_monitor.record_unavailable()
+    logging.warning("Database unavailable: {}".format(error))
+    response = jsonify({"error": "Database unavailable"})
+    response.status_code = 503
+    response.headers["Retry-After"] = "5"
+    return response
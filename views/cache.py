@@ -0,0 +1,194 @@
+"""
+In-memory cache for the CSV and JSON responses.
+Responses for intervals that ended before the ingestion watermark only change when the data generation is bumped,
+so they are kept until evicted and served with an ETag and Last-Modified. Other responses get a short TTL.
+"""
+
+import datetime
+import functools
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from flask import request, Response
+
+from main import app
+from processing import get_ingestion_state
+
+RESPONSE_CACHE_SIZE = app.config['RESPONSE_CACHE_SIZE'] if 'RESPONSE_CACHE_SIZE' in app.config \
+    else 64 * 1024 * 1024  # bytes
+OPEN_RESPONSE_TTL = app.config['OPEN_RESPONSE_TTL'] if 'OPEN_RESPONSE_TTL' in app.config else 60  # seconds
+CLOSED_RESPONSE_MAX_AGE = 24 * 60 * 60
+INGESTION_STATE_TTL = 1
+
+
+class CachedResponse:
+    def __init__(self, body, status, headers, immutable):
+        self.body = body
+        self.status = status
+        self.headers = headers
+        self.immutable = immutable
+        self.etag = hashlib.sha1(body).hexdigest()
+        self.last_modified = datetime.datetime.utcnow()
+        self.expires_at = None if immutable else time.time() + OPEN_RESPONSE_TTL
+
+    def is_expired(self):
+        return self.expires_at is not None and time.time() > self.expires_at
+
+    def make_response(self):
+        response = Response(self.body, status=self.status, headers=self.headers)
+        response.set_etag(self.etag)
+        response.last_modified = self.last_modified
+        response.cache_control.public = True
+        response.cache_control.max_age = CLOSED_RESPONSE_MAX_AGE if self.immutable else OPEN_RESPONSE_TTL
+        return response.make_conditional(request)
+
+
+class ResponseCache:
+    """
+    LRU cache of responses, bounded by the total size of the response bodies.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.metrics = {"hits": 0, "misses": 0, "expired": 0, "evictions": 0, "not_modified": 0, "uncacheable": 0}
+
+    def count(self, metric):
+        with self.lock:
+            self.metrics[metric] += 1
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry.is_expired():
+                self.metrics["expired"] += 1
+                self.remove(key)
+                entry = None
+            if entry is None:
+                self.metrics["misses"] += 1
+                return None
+            self.metrics["hits"] += 1
+            self.entries.move_to_end(key)
+            return entry
+
+    def put(self, key, entry):
+        if len(entry.body) > self.max_size:
+            self.count("uncacheable")
+            return
+        with self.lock:
+            if key in self.entries:
+                self.remove(key)
+            self.entries[key] = entry
+            self.size += len(entry.body)
+            while self.size > self.max_size:
+                self.remove(next(iter(self.entries)))
+                self.metrics["evictions"] += 1
+
+    def remove(self, key):
+        entry = self.entries.pop(key)
+        self.size -= len(entry.body)
+
+    def clear(self):
+        with self.lock:
+            self.entries = OrderedDict()
+            self.size = 0
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.metrics)
+            nb_lookups = stats["hits"] + stats["misses"]
+            stats.update({
+                "entries": len(self.entries),
+                "size": self.size,
+                "max_size": self.max_size,
+                "hit_rate": float(stats["hits"]) / nb_lookups if nb_lookups > 0 else 0
+            })
+            return stats
+
+
+response_cache = ResponseCache(RESPONSE_CACHE_SIZE)
+
+ingestion_state = {"state": None, "loaded_at": 0}
+ingestion_state_lock = threading.Lock()
+
+
+def get_current_ingestion_state():
+    """
+    :return: The ingestion state, reloaded from the metadata collection at most once per INGESTION_STATE_TTL.
+    """
+    with ingestion_state_lock:
+        if ingestion_state["state"] is None or time.time() - ingestion_state["loaded_at"] > INGESTION_STATE_TTL:
+            ingestion_state["state"] = get_ingestion_state()
+            ingestion_state["loaded_at"] = time.time()
+        return ingestion_state["state"]
+
+
+def get_interval_end(interval_string):
+    if interval_string is None:
+        return None
+    try:
+        return int(interval_string.split("-")[1])
+    except (IndexError, ValueError):
+        return None
+
+
+def tee_into_cache(chunks, key, status, headers, immutable):
+    """
+    Yield the chunks of a streamed body and cache the body once all of them were yielded.
+    Bodies larger than the whole cache are not collected.
+    """
+    body = []
+    size = 0
+    for chunk in chunks:
+        if body is not None:
+            body.append(chunk)
+            size += len(chunk)
+            if size > response_cache.max_size:
+                body = None
+        yield chunk
+    if body is None:
+        response_cache.count("uncacheable")
+        return
+    response_cache.put(key, CachedResponse(b"".join(body), status, headers, immutable))
+
+
+def cached_response(view):
+    """
+    Cache the response of a view. Views with an interval argument are cached until evicted once the interval
+    ended before the ingestion watermark. Streamed responses are cached after they were sent.
+    """
+
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        state = get_current_ingestion_state()
+        key = (request.full_path, state["generation"])
+        entry = response_cache.get(key)
+        if entry is None:
+            response = view(*args, **kwargs)
+            if response.status_code != 200 or "Content-Encoding" in response.headers:
+                response_cache.count("uncacheable")
+                return response
+            interval_end = get_interval_end(kwargs.get("interval"))
+            immutable = interval_end is not None and interval_end <= state["watermark"]
+            headers = [(name, value) for name, value in response.headers if name.lower() != "content-length"]
+            if response.is_streamed:
+                # Send the body as it is produced and cache it once it was sent completely.
+                response.response = tee_into_cache(response.iter_encoded(), key, response.status_code, headers,
+                                                   immutable)
+                return response
+            entry = CachedResponse(response.get_data(), response.status_code, headers, immutable)
+            response_cache.put(key, entry)
+        response = entry.make_response()
+        if response.status_code == 304:
+            response_cache.count("not_modified")
+        return response
+
+    return wrapper
+
+
+def get_cache_stats():
+    return response_cache.get_stats()
@@ -0,0 +1,79 @@
+"""
+Streamed responses, so downloads and CSV files never hold the whole body in memory.
+Bodies can be compressed on the fly when the client accepts gzip.
+"""
+
+import csv
+import io
+import zlib
+
+from flask import Response, request
+
+STREAM_CHUNK_SIZE = 64 * 1024  # characters per chunk sent to the client
+GZIP_LEVEL = 6
+
+
+def iter_chunks(parts, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    Group small string parts, such as lines, into chunks of about chunk_size characters.
+    """
+    buffer = []
+    size = 0
+    for part in parts:
+        buffer.append(part)
+        size += len(part)
+        if size >= chunk_size:
+            yield "".join(buffer)
+            buffer = []
+            size = 0
+    if len(buffer) > 0:
+        yield "".join(buffer)
+
+
+def gzip_chunks(chunks):
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode('utf-8'))
+        if len(data) > 0:
+            yield data
+    yield compressor.flush()
+
+
+def accepts_gzip():
+    return "gzip" in request.accept_encodings
+
+
+def iter_csv_lines(rows):
+    line = io.StringIO()
+    writer = csv.writer(line)
+    for row in rows:
+        writer.writerow(row)
+        yield line.getvalue()
+        line.seek(0)
+        line.truncate(0)
+
+
+def stream_response(parts, mimetype, filename=None, compress=True):
+    """
+    :param parts: Iterable of strings forming the response body, consumed while the response is sent.
+    :param compress: Whether to gzip the body when the client accepts it.
+    :return: Streamed response.
+    """
+    chunks = iter_chunks(parts)
+    headers = {"Vary": "Accept-Encoding"} if compress else {}
+    if filename is not None:
+        headers["Content-Disposition"] = "attachment; filename={}".format(filename)
+    if compress and accepts_gzip():
+        headers["Content-Encoding"] = "gzip"
+        body = gzip_chunks(chunks)
+    else:
+        body = (chunk.encode('utf-8') for chunk in chunks)
+    return Response(body, mimetype=mimetype, headers=headers)
+
+
+def stream_csv_response(filename, rows):
+    """
+    :param rows: Iterable of CSV rows, such as a generator, written while the response is sent.
+    :return: Streamed CSV attachment. It is not compressed, so that the response cache can store it.
+    """
+    return stream_response(iter_csv_lines(rows), "text/csv", filename=filename, compress=False)
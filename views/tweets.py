@@ -1,12 +1,55 @@
-from flask import jsonify
+import json
+
+from flask import abort, request
 
 from main import app
-from processing import data
+from processing import data, regions
+from views.streaming import stream_response
+
+DOWNLOAD_BATCH_SIZE = app.config['DOWNLOAD_BATCH_SIZE'] if 'DOWNLOAD_BATCH_SIZE' in app.config else 1000
+
+
+def get_json_array_parts(documents):
+    yield "["
+    for i, document in enumerate(documents):
+        yield ("," if i > 0 else "") + json.dumps(document, sort_keys=True)
+    yield "]"
+
+
+def get_ndjson_parts(documents):
+    for document in documents:
+        yield json.dumps(document, sort_keys=True) + "\n"
 
 
 @app.route('/tweets/<string:interval>/download.json')
 def download_tweets_for_interval(interval):
-    tweets = data.get_tweets_in_interval(data.parse_interval_string(interval))
-    return jsonify([
-        tweet.get_full_dict() for tweet in tweets
-    ])
+    """
+    Stream the tweets of an interval, ordered by timestamp, as a JSON array or as NDJSON with format=ndjson.
+    Optional arguments:
+    - topic and location (region id, sub-regions included) filter the tweets,
+    - limit caps the number of tweets,
+    - cursor resumes after the last tweet received, given as "timestamp:tweet_id:topic".
+    """
+    topic = request.args.get('topic')
+    location_id = request.args.get('location')
+    limit = request.args.get('limit')
+    cursor = request.args.get('cursor')
+    output_format = request.args.get('format', 'json')
+    if output_format not in ("json", "ndjson"):
+        abort(400)
+    if location_id is not None and regions.get_region_by_id(location_id) is None:
+        abort(404)
+    try:
+        interval = data.parse_interval_string(interval)
+        limit = int(limit) if limit is not None else None
+        if cursor is not None:
+            data.parse_download_cursor(cursor)
+    except ValueError:
+        abort(400)
+    if limit is not None and limit < 0:
+        abort(400)
+    documents = data.iter_tweet_documents(interval, topic, location_id, cursor=cursor, limit=limit,
+                                          batch_size=DOWNLOAD_BATCH_SIZE)
+    if output_format == "ndjson":
+        return stream_response(get_ndjson_parts(documents), "application/x-ndjson")
+    return stream_response(get_json_array_parts(documents), "application/json")
@@ -0,0 +1,90 @@
+"""
+Warm-up of the response cache before a WSGI server forks its workers, and the readiness endpoint.
+"""
+
+import logging
+import time
+
+from flask import jsonify
+
+from main import app
+from processing import data, indexes, regions
+from views.cache import get_current_ingestion_state
+
+WARMUP_INTERVALS = app.config['WARMUP_INTERVALS'] if 'WARMUP_INTERVALS' in app.config else 24
+
+warmup_state = {"finished": False, "failed": False, "nb_urls": 0, "duration": None}
+
+
+def get_warmup_urls():
+    """
+    :return: URLs of the responses the front end requests first: topics, intervals, the bubble charts of the latest
+    intervals and the evolution of the current topics.
+    """
+    intervals = sorted(data.get_intervals(), reverse=True)[:WARMUP_INTERVALS]
+    urls = ['/topics.json', '/intervals.json']
+    urls.extend('/bubble_chart/{}/data.csv'.format(data.get_interval_string(interval)) for interval in intervals)
+    urls.extend('/topic/{}/evolution.csv'.format(topic) for topic in data.get_current_topics())
+    return urls
+
+
+def warm_up():
+    """
+    Render the responses of get_warmup_urls into the response cache.
+    """
+    start_time = time.time()
+    client = app.test_client()
+    nb_urls = 0
+    failed = False
+    try:
+        for url in get_warmup_urls():
+            response = client.get(url)
+            # Consume streamed bodies, they are cached once they were sent completely.
+            response.get_data()
+            if response.status_code == 200:
+                nb_urls += 1
+    except Exception as ex:
+        failed = True
+        logging.error("Warm-up failed after {} responses: {}".format(nb_urls, ex))
+    warmup_state.update(finished=True, failed=failed, nb_urls=nb_urls, duration=time.time() - start_time)
+    logging.info("Warmed up {} responses in {:.1f} seconds".format(nb_urls, warmup_state["duration"]))
+
+
+def skip_warm_up():
+    warmup_state["finished"] = True
+
+
+def get_readiness():
+    """
+    :return: Readiness of the components. The caches are ready once the warm-up finished: they also fill up on demand,
+    so a failed warm-up (e.g. on an empty database) does not keep the application unready, warm_up_failed and nb_urls
+    tell how much was cached.
+    """
+    return {
+        "regions": regions.regions_loaded,
+        "indexes": indexes.indexes_created,
+        "caches": warmup_state["finished"],
+        "warm_up_failed": warmup_state["failed"],
+        "nb_urls": warmup_state["nb_urls"]
+    }
+
+
+def is_ready(readiness):
+    return readiness["regions"] and readiness["indexes"] and readiness["caches"]
+
+
+@app.route('/ready')
+def ready():
+    """
+    :return: Readiness of regions, indexes and caches, with status 503 until all of them are ready.
+    """
+    readiness = get_readiness()
+    application_ready = is_ready(readiness)
+    response = jsonify({
+        "ready": application_ready,
+        "components": readiness,
+        "warmup": warmup_state,
+        "ingestion": get_current_ingestion_state()
+    })
+    response.status_code = 200 if application_ready else 503
+    return response
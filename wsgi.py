@@ -0,0 +1,9 @@
+"""
+WSGI entry point for production serving, the expensive state is built before the workers are forked:
+    gunicorn --preload --workers 4 --bind 0.0.0.0:5000 wsgi:application
+    waitress-serve --port=5000 wsgi:application
+"""
+
+from main import create_app
+
+application = create_app()